@@ -0,0 +1,43 @@
+"""
+Counts chat messages that earn points.
+Every message only costs a cooldown check and a counter increment, the counts are handed to the points backend in
+batches by the points cog.
+"""
+
+
+class ActivityTracker:
+    def __init__(self):
+        # (guild id, user id) -> time of the last message that counted
+        self.last_counted = {}
+        # guild id -> {user id: messages counted since the last batch}
+        self.pending = {}
+        self.messages_counted = 0
+        self.batches = 0
+
+    def count(self, guild_id, user_id, cooldown, now):
+        # returns False if the user is still on cooldown
+        key = (guild_id, user_id)
+        last = self.last_counted.get(key)
+        if last is not None and now - last < cooldown:
+            return False
+        self.last_counted[key] = now
+
+        guild_pending = self.pending.get(guild_id)
+        if guild_pending is None:
+            guild_pending = self.pending[guild_id] = {}
+        guild_pending[user_id] = guild_pending.get(user_id, 0) + 1
+        self.messages_counted += 1
+        return True
+
+    def drain(self, max_cooldown, now):
+        # hands over everything counted so far and starts a new batch
+        pending, self.pending = self.pending, {}
+        self.batches += 1
+
+        # forget users whose cooldown is over so this doesn't grow with everyone who ever talked
+        self.last_counted = {key: last for key, last in self.last_counted.items() if now - last < max_cooldown}
+        return pending
+
+    def stats(self):
+        return {"activity messages counted": self.messages_counted, "activity batches": self.batches,
+                "users on cooldown": len(self.last_counted)}
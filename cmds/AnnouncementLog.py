@@ -0,0 +1,85 @@
+import json
+import os
+import time
+from collections import OrderedDict
+
+"""
+Remembers which Twitch streams were announced in which guild, so the same stream is never announced twice and a
+broadcaster is announced at most once per cooldown.
+Entries are dropped once the stream hasn't been seen for longer than the cooldown, the number of entries is capped and
+everything is saved to disk so a restart doesn't announce the streams that are already live again.
+"""
+
+# one announcement per broadcaster in each guild within this many seconds
+COOLDOWN = 6 * 3600
+
+
+class AnnouncementLog:
+    def __init__(self, log_file="./twitch_announcements.json", cooldown=COOLDOWN, max_entries=100000):
+        self.log_file = log_file
+        self.cooldown = cooldown
+        self.max_entries = max_entries
+        # "guild id/login" -> [stream id, time announced, time last seen], least recently seen first
+        self.entries = OrderedDict()
+        self.dirty = False
+        self.evicted = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.log_file, "r") as f:
+                entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            entries = {}
+        self.entries = OrderedDict(sorted(entries.items(), key=lambda item: item[1][2]))
+        self.expire(time.time())
+
+    def snapshot(self, now):
+        # a copy of the entries to be written with save(), None if nothing changed
+        self.expire(now)
+        if not self.dirty:
+            return None
+        self.dirty = False
+        return {key: list(entry) for key, entry in self.entries.items()}
+
+    def save(self, entries):
+        # write to a temporary file and swap it in so a crash never leaves a half written file
+        with open(self.log_file + ".tmp", "w") as f:
+            json.dump(entries, f, separators=(",", ":"))
+        os.replace(self.log_file + ".tmp", self.log_file)
+
+    def claim(self, guild_id, login, stream_id, now):
+        # returns True if the stream should be announced in the guild, and records it
+        key = f"{guild_id}/{login}"
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            # check if we haven't announced this stream by ID
+            if entry[0] == stream_id:
+                entry[2] = now
+                self.dirty = True
+                return False
+            # a new stream within the cooldown isn't announced, and never will be
+            if now - entry[1] <= self.cooldown:
+                entry[0], entry[2] = stream_id, now
+                self.dirty = True
+                return False
+
+        self.entries[key] = [stream_id, now, now]
+        self.entries.move_to_end(key)
+        self.dirty = True
+        self.expire(now)
+        return True
+
+    def expire(self, now):
+        # drop streams that haven't been seen since the cooldown, and the least recently seen beyond the cap
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if now - entry[2] <= self.cooldown and len(self.entries) <= self.max_entries:
+                break
+            del self.entries[key]
+            self.evicted += 1
+            self.dirty = True
+
+    def stats(self):
+        return {"announcement log entries": len(self.entries), "announcement log evictions": self.evicted}
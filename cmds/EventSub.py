@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import hmac
+import json
+from collections import OrderedDict
+from datetime import datetime, timezone
+from aiohttp import web
+
+"""
+Receiver for Twitch EventSub webhooks.
+Runs a small HTTP listener (put it behind an HTTPS reverse proxy, Twitch only calls https on port 443), checks the
+signature and age of every message, drops redelivered messages and hands notifications and revocations to a callback.
+"""
+
+# the events the bot subscribes to for every broadcaster
+EVENT_TYPES = ("stream.online", "stream.offline")
+
+# messages older than this are refused so a captured message can't be replayed
+MAX_MESSAGE_AGE = 600
+
+
+# the signature twitch sends in Twitch-Eventsub-Message-Signature, also used by local stand-ins to sign test messages
+def sign(secret, message_id, timestamp, body):
+    message = message_id.encode() + timestamp.encode() + body
+    return "sha256=" + hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+# seconds since an RFC3339 timestamp such as 2024-05-01T12:00:00.123456789Z, twitch sends up to nanoseconds
+def message_age(timestamp):
+    seconds, _, fraction = timestamp.rstrip("Z").partition(".")
+    sent = datetime.strptime(seconds, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - sent).total_seconds() - float(f"0.{fraction or 0}")
+
+
+class EventSubReceiver:
+    def __init__(self, secret, on_event, host="0.0.0.0", port=8080, path="/eventsub", max_seen=1000):
+        self.secret = secret
+        # called as on_event(message type, subscription, event) for notifications and revocations
+        self.on_event = on_event
+        self.host = host
+        self.port = port
+        self.path = path
+        self.max_seen = max_seen
+        self.runner = None
+        # ids of recent messages, twitch redelivers messages it didn't get a response for in time
+        self.seen = OrderedDict()
+        self.notifications = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.revocations = 0
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        print(f"Listening for Twitch EventSub messages on {self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle(self, request):
+        body = await request.read()
+        message_id = request.headers.get("Twitch-Eventsub-Message-Id")
+        timestamp = request.headers.get("Twitch-Eventsub-Message-Timestamp")
+        signature = request.headers.get("Twitch-Eventsub-Message-Signature")
+        message_type = request.headers.get("Twitch-Eventsub-Message-Type")
+        if not (message_id and timestamp and signature and message_type):
+            self.rejected += 1
+            return web.Response(status=400)
+
+        # only accept messages signed with our secret, and not too old
+        try:
+            too_old = message_age(timestamp) > MAX_MESSAGE_AGE
+        except ValueError:
+            too_old = True
+        if not hmac.compare_digest(sign(self.secret, message_id, timestamp, body), signature) or too_old:
+            self.rejected += 1
+            return web.Response(status=403)
+
+        # acknowledge messages we already handled without handling them again
+        if message_id in self.seen:
+            self.duplicates += 1
+            return web.Response(status=204)
+        self.seen[message_id] = True
+        while len(self.seen) > self.max_seen:
+            self.seen.popitem(last=False)
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self.rejected += 1
+            return web.Response(status=400)
+
+        # twitch checks that we own the callback before it enables a subscription
+        if message_type == "webhook_callback_verification":
+            return web.Response(text=payload.get("challenge", ""), content_type="text/plain")
+
+        if message_type == "notification":
+            self.notifications += 1
+        elif message_type == "revocation":
+            self.revocations += 1
+        else:
+            return web.Response(status=204)
+
+        # answer right away, twitch gives up on slow responses and sends the message again
+        asyncio.get_event_loop().create_task(self.on_event(message_type, payload.get("subscription", {}),
+                                                           payload.get("event")))
+        return web.Response(status=204)
+
+    def stats(self):
+        return {"eventsub notifications": self.notifications, "eventsub duplicates": self.duplicates,
+                "eventsub rejected": self.rejected, "eventsub revocations": self.revocations}
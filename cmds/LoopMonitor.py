@@ -0,0 +1,39 @@
+import asyncio
+import time
+
+"""
+Measures how long the event loop is blocked.
+A task sleeps for a short interval over and over, anything it wakes up late by is time the loop spent stuck in
+something else (blocking I/O, heavy computation, ...) when it should have been handling the gateway and commands.
+"""
+
+
+class LoopMonitor:
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.task = None
+        # longest stall since the last reset and ever
+        self.max_stall = 0.0
+        self.max_stall_ever = 0.0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    async def run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            stall = time.monotonic() - started - self.interval
+            self.max_stall = max(self.max_stall, stall)
+            self.max_stall_ever = max(self.max_stall_ever, stall)
+
+    def reset(self):
+        # returns the longest stall since the previous reset, in seconds
+        stall, self.max_stall = self.max_stall, 0.0
+        return stall
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
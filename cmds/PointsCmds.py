@@ -1,35 +1,293 @@
 import asyncio
+import io
 import json
 import os
+import re
+import tempfile
 import time
+import aiohttp
 import discord
+import numpy as np
 import random
 from discord.ext import commands
 from discord_slash import cog_ext
 from discord_slash.context import SlashContext
-from discord_slash.utils.manage_commands import create_option
+from discord_slash.utils.manage_commands import create_option, create_choice
+from dotenv import load_dotenv
+from cmds.ActivityTracker import ActivityTracker
+from cmds.PointsDecay import ActivityLog, decay_deltas, SECONDS_PER_DAY
+from cmds.PointsExport import FORMATS, write_header, write_rows, detect_format, parse_line
+from cmds.PointsSnapshot import is_user_id
+from cmds.PointsStore import open_points_store
+from cmds.RaffleScheduler import RaffleScheduler
+from cmds.RestQueue import get_rest_queue
+from cmds.UserResolver import UserResolver
 
 """
 Cog for the points commands.
 Author: bradd07
 """
 
+# number of users shown per leaderboard page
+LEADERBOARD_PAGE_SIZE = 5
+
+# summaries name roles without pinging them
+NO_MENTIONS = discord.AllowedMentions.none()
+
+# seconds between handing the counted chat messages to the points backend
+ACTIVITY_BATCH_INTERVAL = 30
+
+# seconds between checking which guilds are due for their decay/interest
+DECAY_CHECK_INTERVAL = 3600
+
 
 class Points(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.points_file = "./points.json"
-        self.points_data = {}
-        self.raffles = {}
-
-        # load the data if the file exists
-        if os.path.exists(self.points_file):
-            with open(self.points_file, "r") as f:
-                self.points_data = json.load(f)
+        # outbound requests go through the bot-wide queue
+        self.rest = get_rest_queue(bot)
+
+        # open the configured points backend
+        load_dotenv()
+        self.store = open_points_store(os.getenv("POINTS_BACKEND"), os.getenv("POINTS_FLUSH_INTERVAL"),
+                                       os.getenv("POINTS_IDLE_TIMEOUT"))
+
+        # resolves user ids to names for the leaderboard
+        self.resolver = UserResolver(bot)
+
+        # one scheduler ends the raffles of every guild, picking up any that were running before a restart
+        self.raffles = RaffleScheduler(self.end_raffle)
+        self.raffle_task = bot.loop.create_task(self.run_raffles())
+
+        # per guild settings, such as points for chat activity
+        self.settings_file = "./points_settings.json"
+        self.settings = {}
+        self.activity_rates = {}
+        self.load_settings()
+
+        # chat messages are counted in memory and turned into points in batches
+        self.activity = ActivityTracker()
+        self.activity_task = bot.loop.create_task(self.award_activity())
+
+        # guilds with a decay/interest policy also remember when each member was last active
+        self.activity_log = ActivityLog()
+        self.decay_timings = {}
+        self.decay_task = bot.loop.create_task(self.apply_decay())
+
+    def cog_unload(self):
+        # stop the raffle scheduler and save the raffles
+        self.raffle_task.cancel()
+        self.raffles.save()
+
+        # stop awarding activity points, anything counted since the last batch is dropped
+        self.activity_task.cancel()
+        self.decay_task.cancel()
+        self.activity_log.save(self.activity_log.take_dirty())
+
+        # flush and close the points backend
+        self.store.close()
+
+    def load_settings(self):
+        # try to open settings file
+        try:
+            with open(self.settings_file, "r") as f:
+                self.settings = json.load(f)
+        except FileNotFoundError:
+            # assume no file exists, set default
+            self.settings = {}
+        self.update_activity_rates()
+
+    def save_settings(self):
+        # open settings file to write
+        with open(self.settings_file, "w") as f:
+            json.dump(self.settings, f)
+        self.update_activity_rates()
+
+    def update_activity_rates(self):
+        # int keyed (points, cooldown) lookup for on_message, only guilds that award points for chatting or need to
+        # know who is active for their decay policy are in here
+        self.activity_rates = {int(guild_id): (data.get("message_points", 0), data.get("message_cooldown", 60))
+                               for guild_id, data in self.settings.items()
+                               if data.get("message_points") or "decay" in data}
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        # ignore bots, direct messages and guilds that don't award points for chatting
+        if message.author.bot or message.guild is None:
+            return
+        rate = self.activity_rates.get(message.guild.id)
+        if rate is None:
+            return
+
+        # count the message unless the user is on cooldown
+        self.activity.count(message.guild.id, message.author.id, rate[1], time.monotonic())
+
+    async def award_activity(self):
+        while True:
+            await asyncio.sleep(ACTIVITY_BATCH_INTERVAL)
+
+            # take everything counted so far
+            max_cooldown = max((cooldown for _, cooldown in self.activity_rates.values()), default=0)
+            pending = self.activity.drain(max_cooldown, time.monotonic())
+
+            # remember who was active for guilds with a decay policy
+            today = int(time.time() // SECONDS_PER_DAY)
+            for guild_id, counts in pending.items():
+                if "decay" in self.settings.get(str(guild_id), {}):
+                    self.activity_log.mark(str(guild_id), (str(user_id) for user_id in counts), today)
+            dirty_logs = self.activity_log.take_dirty()
+            if dirty_logs:
+                try:
+                    await asyncio.get_event_loop().run_in_executor(None, self.activity_log.save, dirty_logs)
+                except OSError as e:
+                    print("Error saving activity log:", e)
+
+            # add the points for each guild as one batch
+            for guild_id, counts in pending.items():
+                rate = self.activity_rates.get(guild_id)
+                if rate is None or rate[0] == 0:
+                    continue
+                try:
+                    await self.store.add_many(str(guild_id), {str(user_id): count * rate[0]
+                                                              for user_id, count in counts.items()}, "activity")
+                except Exception as e:
+                    print(f"Error awarding activity points for guild {guild_id}:", e)
+
+    async def apply_decay(self):
+        while True:
+            # apply the policy of every guild that is due
+            now = time.time()
+            for guild_id, data in list(self.settings.items()):
+                policy = data.get("decay")
+                if policy is None or now < policy["last_run"] + policy["interval_days"] * SECONDS_PER_DAY:
+                    continue
+                try:
+                    await self.decay_guild(guild_id, policy)
+                except Exception as e:
+                    print(f"Error applying points decay for guild {guild_id}:", e)
+                policy["last_run"] = now
+                self.save_settings()
+
+            await asyncio.sleep(DECAY_CHECK_INTERVAL)
+
+    async def decay_guild(self, guild_id, policy):
+        start = time.perf_counter()
+
+        # copy the balances into arrays. nothing in this loop awaits other than the backend itself
+        user_ids = []
+        chunks = []
+        async for chunk in self.store.iter_guild(guild_id):
+            user_ids.extend(user_id for user_id, _ in chunk)
+            chunks.append(np.fromiter((points for _, points in chunk), dtype=np.int64, count=len(chunk)))
+        if not user_ids:
+            return
+        balances = np.concatenate(chunks)
+
+        # members we have never seen chat count as last active when the policy was set
+        guild_log = self.activity_log.guild(guild_id)
+        since_day = int(policy["since"] // SECONDS_PER_DAY)
+        last_seen = np.fromiter((guild_log.get(user_id, since_day) for user_id in user_ids), dtype=np.int64,
+                                count=len(user_ids))
+
+        # work out every change in one pass off the event loop
+        today = int(time.time() // SECONDS_PER_DAY)
+        deltas = await asyncio.get_event_loop().run_in_executor(
+            None, decay_deltas, balances, last_seen, today, policy["percent"], policy["inactive_days"])
+
+        # apply the changes as one batch. these are deltas rather than new balances, so anything that changed while
+        # we were working isn't overwritten
+        changed = np.flatnonzero(deltas)
+        if len(changed):
+            await self.store.add_many(guild_id, {user_ids[i]: int(deltas[i]) for i in changed}, "decay")
+
+        # report how long it took
+        elapsed = time.perf_counter() - start
+        self.decay_timings[guild_id] = elapsed
+        print(f"Applied points decay to guild {guild_id}: {len(changed)} of {len(user_ids)} balances changed in "
+              f"{elapsed * 1000:.1f} ms")
+
+    @cog_ext.cog_slash(name="pointsdecay", description="Set a scheduled decay (negative) or interest (positive) on points",
+                       options=[
+                           create_option(
+                               name="percent",
+                               description="Percent of each balance to add or remove (0 to turn it off)",
+                               option_type=4,
+                               required=True
+                           ),
+                           create_option(
+                               name="interval_days",
+                               description="Days between each time it is applied (defaults to 7)",
+                               option_type=4,
+                               required=False
+                           ),
+                           create_option(
+                               name="inactive_days",
+                               description="Only apply to members who haven't chatted for this many days (defaults "
+                                           "to everyone)",
+                               option_type=4,
+                               required=False
+                           )
+                       ])
+    @commands.has_permissions(manage_guild=True)
+    async def set_decay(self, ctx: SlashContext, percent: int, interval_days: int = 7, inactive_days: int = 0):
+        # check for invalid values
+        if percent < -100 or interval_days <= 0 or inactive_days < 0:
+            await self.rest.respond(ctx, "> Please provide a valid percent, interval and inactivity period.",
+                                    hidden=True)
+            return
+
+        # turn it off
+        guild_settings = self.settings.setdefault(str(ctx.guild.id), {})
+        if percent == 0:
+            guild_settings.pop("decay", None)
+            self.save_settings()
+            await self.rest.respond(ctx, "> Points no longer decay or earn interest in this guild.")
+            return
+
+        # save the policy, it is first applied one interval from now
+        now = time.time()
+        guild_settings["decay"] = {"percent": percent, "interval_days": interval_days, "inactive_days": inactive_days,
+                                   "since": guild_settings.get("decay", {}).get("since", now), "last_run": now}
+        self.save_settings()
+
+        # notify
+        who = f"members inactive for {inactive_days} days" if inactive_days else "everyone"
+        await self.rest.respond(ctx, f"> Every {interval_days} days, the points of {who} will change by {percent:+}%.")
+
+    @cog_ext.cog_slash(name="pointsactivity", description="Set how many points members earn for chatting",
+                       options=[
+                           create_option(
+                               name="points",
+                               description="Points earned per message (0 to turn it off)",
+                               option_type=4,
+                               required=True
+                           ),
+                           create_option(
+                               name="cooldown",
+                               description="Seconds before another message from the same user earns points",
+                               option_type=4,
+                               required=False
+                           )
+                       ])
+    @commands.has_permissions(manage_guild=True)
+    async def set_activity_points(self, ctx: SlashContext, points: int, cooldown: int = 60):
+        # check for invalid values
+        if points < 0 or cooldown < 0:
+            await self.rest.respond(ctx, "> Please provide a valid amount and cooldown.", hidden=True)
+            return
+
+        # save the rate for this guild
+        guild_settings = self.settings.setdefault(str(ctx.guild.id), {})
+        guild_settings["message_points"] = points
+        guild_settings["message_cooldown"] = cooldown
+        self.save_settings()
+
+        # notify
+        if points == 0:
+            await self.rest.respond(ctx, "> Members no longer earn points for chatting.")
         else:
-            # otherwise create an empty file
-            with open(self.points_file, "w") as f:
-                json.dump(self.points_data, f)
+            await self.rest.respond(
+                ctx, f"> Members now earn {points} points per message, at most once every {cooldown} seconds.")
 
     @cog_ext.cog_slash(name="points", description="Displays the user's current amount of points on that guild")
     async def display_points(self, ctx: SlashContext, user: discord.User = None):
@@ -41,20 +299,11 @@ class Points(commands.Cog):
         user_id = str(user.id)
         guild_id = str(ctx.guild.id)
 
-        # check if this guild is saved yet
-        if guild_id not in self.points_data:
-            self.points_data[guild_id] = {}
-
-        # check if this user is saved yet
-        if user_id not in self.points_data[guild_id]:
-            # set default
-            self.points_data[guild_id][user_id] = 0
-
         # get points
-        points = self.points_data[guild_id][user_id]
+        points = await self.store.get(guild_id, user_id)
 
         # notify
-        await ctx.send(f"> {user.display_name} has {points} points.")
+        await self.rest.respond(ctx, f"> {user.display_name} has {points} points.")
 
     @cog_ext.cog_slash(name="setpoints", description="Set the amount of points a user has", options=[
         create_option(
@@ -76,60 +325,78 @@ class Points(commands.Cog):
         user_id = str(user.id)
         guild_id = str(ctx.guild.id)
 
-        # check if this guild is saved yet
-        if guild_id not in self.points_data:
-            self.points_data[guild_id] = {}
-
         # set points
-        self.points_data[guild_id][user_id] = points
-
-        # write to file
-        with open(self.points_file, "w") as f:
-            json.dump(self.points_data, f)
+        await self.store.set(guild_id, user_id, points)
 
         # notify
-        await ctx.send(f"> {user.display_name} now has {points} points.")
+        await self.rest.respond(ctx, f"> {user.display_name} now has {points} points.")
 
     @cog_ext.cog_slash(name="addpoints", description="Adds points to the specified user's current total in that guild",
                        options=[
+                           create_option(
+                               name="amount",
+                               description="The amount of points you want to add",
+                               option_type=4,
+                               required=True
+                           ),
                            create_option(
                                name="user",
                                description="The user you want to add points to",
                                option_type=6,
-                               required=True
+                               required=False
                            ),
                            create_option(
-                               name="amount",
-                               description="The amount of points you want to add",
-                               option_type=4,
-                               required=True
+                               name="role",
+                               description="Add points to every member with this role instead",
+                               option_type=8,
+                               required=False
+                           ),
+                           create_option(
+                               name="users",
+                               description="Add points to a list of user mentions or IDs instead",
+                               option_type=3,
+                               required=False
                            )
                        ])
     @commands.has_permissions(manage_guild=True)
-    async def add_points(self, ctx: SlashContext, user: discord.User, amount: int):
+    async def add_points(self, ctx: SlashContext, amount: int, user: discord.User = None, role: discord.Role = None,
+                         users: str = None):
+        # make sure exactly one target was given
+        if sum(target is not None for target in (user, role, users)) != 1:
+            await self.rest.respond(ctx, "> Please specify either a user, a role or a list of users.", hidden=True)
+            return
+
         # make sure we have strings
-        user_id = str(user.id)
         guild_id = str(ctx.guild.id)
 
-        # check if this guild is saved yet
-        if guild_id not in self.points_data:
-            self.points_data[guild_id] = {}
-
-        # check if this user is saved yet
-        if user_id not in self.points_data[guild_id]:
-            # set default
-            self.points_data[guild_id][user_id] = 0
+        # add points to a single user
+        if user is not None:
+            new_points = await self.store.add(guild_id, str(user.id), amount)
+            await self.rest.respond(ctx, f"> {user.display_name} now has {new_points} points (added {amount} points).")
+            return
 
-        # add points
-        self.points_data[guild_id][user_id] += amount
-        new_points = self.points_data[guild_id][user_id]
+        # otherwise collect everyone in the role or the list
+        if role is not None:
+            user_ids = [str(member.id) for member in role.members if not member.bot]
+            target = f"members of {role.mention}"
+        else:
+            user_ids = re.findall(r"\d{15,20}", users)
+            target = "listed users"
 
-        # write to file
-        with open(self.points_file, "w") as f:
-            json.dump(self.points_data, f)
+        # add points to all of them at once
+        granted = await self.grant_points(guild_id, user_ids, amount)
+        if granted == 0:
+            await self.rest.respond(ctx, "> There is no one to add points to.", hidden=True)
+            return
+        await self.rest.respond(ctx, f"> Added {amount} points to {granted} {target}.", allowed_mentions=NO_MENTIONS)
 
-        # notify
-        await ctx.send(f"> {user.display_name} now has {new_points} points (added {amount} points).")
+    async def grant_points(self, guild_id, user_ids, amount, reason="add"):
+        # applies the same amount to every user in a single batch, returns how many users got points. ids that can't
+        # be discord ids are skipped
+        deltas = dict.fromkeys((user_id for user_id in user_ids if is_user_id(user_id)), amount)
+        if deltas:
+            await self.store.add_many(guild_id, deltas, reason)
+        return len(deltas)
 
     @cog_ext.cog_slash(name="givepoints", description="Give some of your points to another player in the same guild",
                        options=[
@@ -149,7 +416,7 @@ class Points(commands.Cog):
     async def give_points(self, ctx: SlashContext, user: discord.User, amount: int):
         # check for invalid amount
         if amount <= 0:
-            await ctx.send("> The amount of points must be greater than 0.")
+            await self.rest.respond(ctx, "> The amount of points must be greater than 0.")
             return
 
         # make sure we have strings
@@ -157,62 +424,221 @@ class Points(commands.Cog):
         guild_id = str(ctx.guild.id)
         author_id = str(ctx.author.id)
 
-        # check if this guild is saved yet
-        if guild_id not in self.points_data:
-            self.points_data[guild_id] = {}
-
-        # check if the sender is saved yet
-        if author_id not in self.points_data[guild_id]:
-            # set default
-            self.points_data[guild_id][author_id] = 0
-
-        # check if the sender does not have enough funds
-        if self.points_data[guild_id][author_id] < amount:
-            await ctx.send("> You don't have enough points to give.")
+        # update points, fails if the sender does not have enough funds
+        new_points = await self.store.transfer(guild_id, author_id, user_id, amount)
+        if new_points is None:
+            await self.rest.respond(ctx, "> You don't have enough points to give.")
             return
 
-        # check if the specified user is saved yet
-        if user_id not in self.points_data[guild_id]:
-            # set default
-            self.points_data[guild_id][user_id] = 0
-
-        # update points
-        self.points_data[guild_id][author_id] -= amount
-        self.points_data[guild_id][user_id] += amount
-        new_points = self.points_data[guild_id][user_id]
-
-        # write to file
-        with open(self.points_file, "w") as f:
-            json.dump(self.points_data, f)
-
         # notify
-        await ctx.send(
-            f"> You gave {amount} points to {user.display_name}. {user.display_name} now has {new_points} points.")
+        await self.rest.respond(
+            ctx, f"> You gave {amount} points to {user.display_name}. {user.display_name} now has {new_points} points.")
 
-    @cog_ext.cog_slash(name="leaderboard", description="Displays the top 5 users with the most points in that guild")
-    async def leaderboard(self, ctx: SlashContext):
+    @cog_ext.cog_slash(name="leaderboard", description="Displays the users with the most points in that guild",
+                       options=[
+                           create_option(
+                               name="page",
+                               description="The page of the leaderboard you want to see",
+                               option_type=4,
+                               required=False
+                           )
+                       ])
+    async def leaderboard(self, ctx: SlashContext, page: int = 1):
         # get guild
         guild_id = str(ctx.guild.id)
 
-        # check if this guild is saved yet
-        if guild_id not in self.points_data:
-            self.points_data[guild_id] = {}
+        # check for an invalid page
+        total_users = await self.store.count(guild_id)
+        total_pages = max(1, -(-total_users // LEADERBOARD_PAGE_SIZE))
+        if page <= 0 or page > total_pages:
+            await self.rest.respond(ctx, f"> Please provide a page between 1 and {total_pages}.")
+            return
+
+        # get the users on this page by their points
+        offset = (page - 1) * LEADERBOARD_PAGE_SIZE
+        sorted_users = await self.store.top(guild_id, LEADERBOARD_PAGE_SIZE, offset)
 
-        # sort the users by their points, and only take the top 5
-        sorted_users = sorted(self.points_data[guild_id].items(), key=lambda x: x[1], reverse=True)[:5]
+        # look up everyone's name at once
+        names = await self.resolver.display_names(ctx.guild, [user_id for user_id, _ in sorted_users])
 
         # create a nicely formatted leaderboard embed
         leaderboard_embed = discord.Embed(title="Leaderboard")
-        for i, (user_id, points) in enumerate(sorted_users):
-            try:
-                user = await self.bot.fetch_user(int(user_id))
-                leaderboard_embed.add_field(name=f"**@{user.display_name}**", value=f"{points} points",
+        for i, (user_id, points) in enumerate(sorted_users, start=offset + 1):
+            if names[user_id]:
+                leaderboard_embed.add_field(name=f"**#{i} @{names[user_id]}**", value=f"{points} points",
                                             inline=False)
-            except discord.NotFound:
-                leaderboard_embed.add_field(name=f"Unknown User", value=f"{points} points", inline=False)
+            else:
+                leaderboard_embed.add_field(name=f"#{i} Unknown User", value=f"{points} points", inline=False)
+        leaderboard_embed.set_footer(text=f"Page {page}/{total_pages}")
+
+        # send the message
+        await self.rest.respond(ctx, embed=leaderboard_embed)
+
+    @cog_ext.cog_slash(name="rank", description="Displays the user's position on the leaderboard in that guild",
+                       options=[
+                           create_option(
+                               name="user",
+                               description="The user you want to see the rank of",
+                               option_type=6,
+                               required=False
+                           )
+                       ])
+    async def rank(self, ctx: SlashContext, user: discord.User = None):
+        # if user is not specified, assume they want their own rank
+        if user is None:
+            user = ctx.author
+
+        # make sure we have strings
+        user_id = str(user.id)
+        guild_id = str(ctx.guild.id)
+
+        # look up their position
+        rank = await self.store.rank(guild_id, user_id)
+        if rank is None:
+            await self.rest.respond(ctx, f"> {user.display_name} is not on the leaderboard yet.")
+            return
+
+        # notify
+        points = await self.store.get(guild_id, user_id)
+        total_users = await self.store.count(guild_id)
+        await self.rest.respond(ctx, f"> {user.display_name} is ranked #{rank} of {total_users} with {points} points.")
+
+    @cog_ext.cog_slash(name="pointshistory", description="Displays the user's most recent point transactions in that guild",
+                       options=[
+                           create_option(
+                               name="user",
+                               description="The user you want to see the transactions of",
+                               option_type=6,
+                               required=False
+                           )
+                       ])
+    async def points_history(self, ctx: SlashContext, user: discord.User = None):
+        # if user is not specified, assume they want their own history
+        if user is None:
+            user = ctx.author
+
+        # get the most recent transactions from the ledger
+        history = await self.store.get_history(str(ctx.guild.id), str(user.id))
+        if not history:
+            await self.rest.respond(ctx, f"> {user.display_name} has no recent point transactions.")
+            return
+
+        # create a nicely formatted history embed
+        history_embed = discord.Embed(title=f"{user.display_name}'s Recent Transactions")
+        for entry in history:
+            history_embed.add_field(name=f"{entry['delta']:+} points ({entry['reason']})",
+                                    value=f"<t:{entry['ts']}:f> • balance {entry['balance']}", inline=False)
 
         # send the message
-        await ctx.send(embed=leaderboard_embed)
+        await self.rest.respond(ctx, embed=history_embed)
+
+    @cog_ext.cog_slash(name="pointsstats", description="Displays statistics about the points storage")
+    @commands.has_permissions(manage_guild=True)
+    async def points_stats(self, ctx: SlashContext):
+        # list every counter the backend, the name resolver and the activity tracker keep
+        counters = {**self.store.stats(), **self.resolver.stats(), **self.activity.stats()}
+        guild_id = str(ctx.guild.id)
+        if guild_id in self.decay_timings:
+            counters["last decay run (ms)"] = round(self.decay_timings[guild_id] * 1000, 1)
+        stats = "\n".join(f"> {name}: {value}" for name, value in counters.items())
+        await self.rest.respond(ctx, f"Points storage statistics:\n{stats}", hidden=True)
+
+    @cog_ext.cog_subcommand(
+        base="pointsdata",
+        name="export",
+        description="Export every balance in this guild to a file",
+        options=[
+            create_option(
+                name="format",
+                description="The file format (defaults to CSV)",
+                option_type=3,
+                required=False,
+                choices=[create_choice(name=fmt.upper(), value=fmt) for fmt in FORMATS]
+            )
+        ]
+    )
+    @commands.has_permissions(manage_guild=True)
+    async def export_points(self, ctx: SlashContext, format: str = "csv"):
+        await self.rest.defer(ctx)
+        guild_id = str(ctx.guild.id)
+
+        # stream the balances into a temporary file one chunk at a time. nothing in this loop awaits other than the
+        # backend itself, so the guild can't change halfway through the export
+        raw_file = tempfile.TemporaryFile()
+        fp = io.TextIOWrapper(raw_file, encoding="utf-8", newline="")
+        exported = 0
+        write_header(fp, format)
+        async for chunk in self.store.iter_guild(guild_id):
+            write_rows(fp, format, chunk)
+            exported += len(chunk)
+        fp.flush()
+        fp.detach()
+        raw_file.seek(0)
+
+        # send the file
+        await self.rest.respond(ctx, f"> Exported {exported} balances.",
+                                file=discord.File(raw_file, filename=f"points-{guild_id}.{FORMATS[format]}"))
+        raw_file.close()
+
+    @cog_ext.cog_subcommand(
+        base="pointsdata",
+        name="import",
+        description="Import balances from a CSV or NDJSON file attached to a message",
+        options=[
+            create_option(
+                name="message_id",
+                description="The message ID of the message with the file attached (in this channel)",
+                option_type=3,
+                required=True
+            )
+        ]
+    )
+    @commands.has_permissions(manage_guild=True)
+    async def import_points(self, ctx: SlashContext, message_id: str):
+        await self.rest.defer(ctx, hidden=True)
+        guild_id = str(ctx.guild.id)
+
+        # get the message object from the message ID
+        try:
+            message = await ctx.channel.fetch_message(int(message_id))
+        except (discord.NotFound, ValueError):
+            await self.rest.respond(ctx, "> The specified message does not exist for this channel. (hint: use this "
+                                    "command in the same channel as the message!)", hidden=True)
+            return
+
+        # make sure there is a file we can read
+        if not message.attachments:
+            await self.rest.respond(ctx, "> The specified message has no file attached.", hidden=True)
+            return
+        attachment = message.attachments[0]
+        fmt = detect_format(attachment.filename)
+        if fmt is None:
+            await self.rest.respond(ctx, "> The attached file must be a .csv or .ndjson file.", hidden=True)
+            return
+
+        # read the file line by line as it downloads
+        balances = {}
+        invalid = 0
+        async with aiohttp.ClientSession() as session:
+            async with session.get(attachment.url) as response:
+                if response.status != 200:
+                    await self.rest.respond(ctx, "> Failed to download the attached file.", hidden=True)
+                    return
+                async for line in response.content:
+                    try:
+                        row = parse_line(fmt, line.decode("utf-8"))
+                    except ValueError:
+                        invalid += 1
+                        continue
+                    if row:
+                        user_id, points = row
+                        balances[user_id] = points
+
+        # apply everything as one batch
+        if balances:
+            await self.store.set_many(guild_id, balances, reason="import")
+        await self.rest.respond(ctx, f"> Imported {len(balances)} balances ({invalid} invalid lines skipped).",
+                                hidden=True)
 
     @cog_ext.cog_slash(name="raffle", description="Create a raffle for free points")
     @commands.has_permissions(manage_guild=True)
@@ -220,68 +646,48 @@ class Points(commands.Cog):
         # get guild
         guild_id = str(ctx.guild.id)
 
-        # check if this guild is saved yet
-        if guild_id not in self.raffles:
-            # set default
-            self.raffles[guild_id] = {"active": False}
-
         # check if this guild has an active raffle
-        if self.raffles[guild_id]["active"]:
-            await ctx.send("> There is already an ongoing raffle in this guild.")
+        if self.raffles.get(guild_id):
+            await self.rest.respond(ctx, "> There is already an ongoing raffle in this guild.")
             return
 
         # check for invalid amount/duration
         if amount <= 0 or duration <= 0:
-            await ctx.send("> Please provide a valid amount and duration.")
+            await self.rest.respond(ctx, "> Please provide a valid amount and duration.")
             return
 
-        # save values
-        self.raffles[guild_id]["active"] = True
-        self.raffles[guild_id]["amount"] = amount
-        self.raffles[guild_id]["end_time"] = time.time() + duration
-        self.raffles[guild_id]["participants"] = []
+        # save values, the scheduler ends the raffle once the duration is up
+        self.raffles.create(guild_id, ctx.channel.id, amount, duration)
 
         # notify
-        await ctx.send(f"A raffle for {amount} points has been created. Type /join to participate!")
+        await self.rest.respond(ctx, f"A raffle for {amount} points has been created. Type /join to participate!")
 
-        # wait until we have reached the end time
-        while time.time() < self.raffles[guild_id]["end_time"]:
-            await asyncio.sleep(1)
+    async def run_raffles(self):
+        # raffles announce their winner in a channel, so wait until we can see the channels
+        await self.bot.wait_until_ready()
+        await self.raffles.run()
 
-        # end the raffle, pick winner
-        await self.end_raffle(ctx, guild_id)
-
-    async def end_raffle(self, ctx, guild_id):
-        # make sure there is an active raffle
-        if not self.raffles[guild_id]["active"]:
+    async def end_raffle(self, guild_id, raffle):
+        # get the channel the raffle was created in
+        channel = self.bot.get_channel(raffle["channel_id"])
+        if channel is None:
             return
 
-        # update flag
-        self.raffles[guild_id]["active"] = False
-
         # check that there were actually participants
-        if not self.raffles[guild_id]["participants"]:
-            await ctx.send("No one participated in the raffle. Better luck next time!")
+        if not raffle["participants"]:
+            await self.rest.send(channel, "No one participated in the raffle. Better luck next time!")
             return
 
         # get a random winner
-        winner = random.choice(self.raffles[guild_id]["participants"])
-        user_id = str(winner.id)
-
-        # make sure we have this user saved for this guild
-        if user_id not in self.points_data[guild_id]:
-            # if not, set default
-            self.points_data[guild_id][user_id] = 0
+        user_id = random.choice(list(raffle["participants"]))
 
         # update points
-        self.points_data[guild_id][user_id] += self.raffles[guild_id]["amount"]
-
-        # write to file
-        with open(self.points_file, "w") as f:
-            json.dump(self.points_data, f)
+        await self.store.add(guild_id, user_id, raffle["amount"], reason="raffle")
 
         # notify winner
-        await ctx.send(f"{winner.display_name} won the raffle and got {self.raffles[guild_id]['amount']} points!")
+        names = await self.resolver.display_names(self.bot.get_guild(int(guild_id)), [user_id])
+        await self.rest.send(channel,
+                             f"{names[user_id] or 'Unknown User'} won the raffle and got {raffle['amount']} points!")
 
     @cog_ext.cog_slash(name="join", description="Join the ongoing raffle in that guild")
     async def join_raffle(self, ctx: SlashContext):
@@ -289,21 +695,15 @@ class Points(commands.Cog):
         guild_id = str(ctx.guild.id)
 
         # make sure there is an ongoing raffle
-        if guild_id not in self.raffles:
-            await ctx.send("> There is no ongoing raffle in this server.")
+        if not self.raffles.get(guild_id):
+            await self.rest.respond(ctx, "> There is no ongoing raffle in this server.")
             return
 
-        # get the raffle for this guild
-        raffle = self.raffles[guild_id]
-
-        # make sure they haven't already joined this raffle
-        if ctx.author in raffle["participants"]:
-            await ctx.send("> You have already joined the raffle.")
+        # add the user to the raffle if they haven't already joined, notify
+        if not self.raffles.join(guild_id, str(ctx.author.id)):
+            await self.rest.respond(ctx, "> You have already joined the raffle.")
             return
-
-        # add the user to the raffle, notify
-        raffle["participants"].append(ctx.author)
-        await ctx.send(f"> {ctx.author.display_name} has joined the raffle.")
+        await self.rest.respond(ctx, f"> {ctx.author.display_name} has joined the raffle.")
 
 
 def setup(bot):
@@ -0,0 +1,63 @@
+import json
+import os
+import numpy as np
+
+"""
+Helpers for the scheduled points decay/interest.
+The policy is applied to a whole guild at once on numpy arrays, and the last day each member was active in chat is
+kept per guild so the policy can be limited to inactive members.
+"""
+
+SECONDS_PER_DAY = 86400
+
+
+# returns the change for every balance, rounded down. only positive balances of members who have been inactive for at
+# least inactive_days are changed (inactive_days 0 changes everyone)
+def decay_deltas(balances, last_seen, today, percent, inactive_days):
+    inactive = (today - last_seen) >= inactive_days
+    # large interest is capped below the int64 limit (the largest float under 2 ** 63) instead of overflowing
+    adjusted = np.floor(balances * (1 + percent / 100))
+    adjusted = np.clip(adjusted, -2.0 ** 63, np.nextafter(2.0 ** 63, 0)).astype(np.int64)
+    return np.where(inactive & (balances > 0), adjusted - balances, 0)
+
+
+# last day (days since the epoch) each member was active in chat, per guild
+class ActivityLog:
+    def __init__(self, log_dir="./points_activity"):
+        self.log_dir = log_dir
+        self.guilds = {}
+        self.dirty = set()
+
+        # ensure the directory exists
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+
+    def guild(self, guild_id):
+        # load the guild the first time it is needed
+        if guild_id not in self.guilds:
+            try:
+                with open(os.path.join(self.log_dir, f"{guild_id}.json"), "r") as f:
+                    self.guilds[guild_id] = json.load(f)
+            except FileNotFoundError:
+                self.guilds[guild_id] = {}
+        return self.guilds[guild_id]
+
+    def mark(self, guild_id, user_ids, day):
+        guild_log = self.guild(guild_id)
+        for user_id in user_ids:
+            guild_log[user_id] = day
+        self.dirty.add(guild_id)
+
+    def take_dirty(self):
+        # copies of the guilds that changed, to be written with save()
+        dirty = {guild_id: dict(self.guilds[guild_id]) for guild_id in self.dirty}
+        self.dirty.clear()
+        return dirty
+
+    def save(self, guilds):
+        for guild_id, guild_log in guilds.items():
+            # write to a temporary file and swap it in so a crash never leaves a half written file
+            log_file = os.path.join(self.log_dir, f"{guild_id}.json")
+            with open(log_file + ".tmp", "w") as f:
+                json.dump(guild_log, f)
+            os.replace(log_file + ".tmp", log_file)
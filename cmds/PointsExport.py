@@ -0,0 +1,66 @@
+import csv
+import json
+from cmds.PointsSnapshot import is_user_id, MIN_POINTS, MAX_POINTS
+
+"""
+Reading and writing guild balances as CSV or NDJSON for the points import/export commands.
+Both formats are handled one row at a time so a file never has to be held in memory.
+"""
+
+# supported formats and their file extensions
+FORMATS = {"csv": "csv", "ndjson": "ndjson"}
+
+
+# writes a header for the format, if it has one
+def write_header(fp, fmt):
+    if fmt == "csv":
+        csv.writer(fp).writerow(["user_id", "points"])
+
+
+# writes a chunk of (user id, points) rows
+def write_rows(fp, fmt, rows):
+    if fmt == "csv":
+        csv.writer(fp).writerows(rows)
+    else:
+        fp.writelines(json.dumps({"user_id": user_id, "points": points}) + "\n" for user_id, points in rows)
+
+
+# guesses the format from a file name, returns None if it isn't supported
+def detect_format(file_name):
+    extension = file_name.rsplit(".", 1)[-1].lower()
+    if extension in ("json", "jsonl"):
+        return "ndjson"
+    return extension if extension in FORMATS else None
+
+
+# parses one line into (user id, points), returns None for blank lines and the csv header
+# raises ValueError if the line is malformed
+def parse_line(fmt, line):
+    line = line.strip().lstrip("\ufeff")
+    if not line:
+        return None
+
+    if fmt == "csv":
+        fields = next(csv.reader([line]))
+        if len(fields) != 2:
+            raise ValueError("expected user_id,points")
+        user_id, points = fields[0].strip(), fields[1].strip()
+        # skip the header
+        if user_id == "user_id":
+            return None
+    else:
+        row = json.loads(line)
+        if not isinstance(row, dict):
+            raise ValueError("expected an object")
+        user_id, points = str(row.get("user_id", "")), row.get("points")
+
+    # discord ids are always numbers that fit in 64 bits
+    if not is_user_id(user_id):
+        raise ValueError(f"invalid user id {user_id!r}")
+    try:
+        points = int(points)
+    except TypeError:
+        raise ValueError(f"invalid points {points!r}")
+    if not MIN_POINTS <= points <= MAX_POINTS:
+        raise ValueError(f"points out of range {points!r}")
+    return user_id, points
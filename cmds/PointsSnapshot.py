@@ -0,0 +1,95 @@
+import mmap
+import os
+import re
+import struct
+
+"""
+Compact binary snapshot of one guild's balances.
+A small header followed by fixed-width (user id, balance) records sorted by user id, so a snapshot can be memory-mapped
+and searched in place without building any Python objects for the users that aren't looked at.
+"""
+
+MAGIC = b"PTS1"
+# magic, number of records
+HEADER = struct.Struct("<4sI")
+# user id, balance
+RECORD = struct.Struct("<Qq")
+# the balances a record can hold
+MIN_POINTS = -2 ** 63
+MAX_POINTS = 2 ** 63 - 1
+
+
+# the balance limited to what a record can hold
+def clamp_points(points):
+    return min(max(points, MIN_POINTS), MAX_POINTS)
+
+
+# True if the user id fits in a record, discord ids always do. leading zeros are refused so every id has one spelling
+def is_user_id(user_id):
+    return isinstance(user_id, str) and re.fullmatch(r"[1-9][0-9]{0,19}", user_id) is not None \
+        and int(user_id) < 2 ** 64
+
+
+# writes the balances of one guild, user ids that don't fit in a record are left out
+def write_snapshot(path, users):
+    records = sorted((int(user_id), points) for user_id, points in users.items() if is_user_id(user_id))
+    buffer = bytearray(HEADER.size + len(records) * RECORD.size)
+    HEADER.pack_into(buffer, 0, MAGIC, len(records))
+    for i, (user_id, points) in enumerate(records):
+        RECORD.pack_into(buffer, HEADER.size + i * RECORD.size, user_id, clamp_points(points))
+
+    # write to a temporary file and swap it in so a crash never leaves a half written snapshot
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(buffer)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+
+class GuildSnapshot:
+    def __init__(self, path):
+        # raises ValueError if the file is empty, truncated or not a snapshot
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < HEADER.size:
+            self.data.close()
+            raise ValueError(f"{path} is truncated")
+        magic, self.count = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or len(self.data) != HEADER.size + self.count * RECORD.size:
+            self.data.close()
+            raise ValueError(f"{path} is not a points snapshot")
+
+    def __len__(self):
+        return self.count
+
+    def record(self, i):
+        return RECORD.unpack_from(self.data, HEADER.size + i * RECORD.size)
+
+    def get(self, user_id, default=0):
+        # binary search on the sorted records
+        user_id = int(user_id)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record_id, points = self.record(middle)
+            if record_id == user_id:
+                return points
+            if record_id < user_id:
+                low = middle + 1
+            else:
+                high = middle
+        return default
+
+    def chunk(self, start, size):
+        # a list of (user id, points) for up to size records starting at start
+        end = min(start + size, self.count)
+        data = self.data[HEADER.size + start * RECORD.size:HEADER.size + end * RECORD.size]
+        return [(str(user_id), points) for user_id, points in RECORD.iter_unpack(data)]
+
+    def to_dict(self):
+        data = self.data[HEADER.size:HEADER.size + self.count * RECORD.size]
+        return {str(user_id): points for user_id, points in RECORD.iter_unpack(data)}
+
+    def close(self):
+        self.data.close()
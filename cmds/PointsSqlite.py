@@ -0,0 +1,263 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from cmds.PointsSnapshot import GuildSnapshot, clamp_points
+
+"""
+SQLite backend for the points cog.
+Balances are kept in an indexed table instead of in memory, so leaderboards and lookups are indexed queries. Only the
+most recent transactions of each user are kept, like the ledger backend.
+"""
+
+
+class SqlitePointsStore:
+    def __init__(self, db_file="./points.db", shard_dir="./points", ledger_file="./points.ledger",
+                 legacy_file="./points.json", history_size=25):
+        self.db_file = db_file
+        self.shard_dir = shard_dir
+        self.ledger_file = ledger_file
+        self.legacy_file = legacy_file
+        # transactions kept per user
+        self.history_size = history_size
+        self.db = None
+        self.queries = 0
+
+        # sqlite connections belong to the thread that opened them, so every query runs on one dedicated worker
+        # thread and the event loop only awaits the result
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="points-sqlite")
+        self.executor.submit(self.open).result()
+
+    def open(self):
+        self.db = sqlite3.connect(self.db_file)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+
+        # create the tables and indexes if they don't exist yet
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS points ("
+                            "guild_id TEXT NOT NULL, user_id TEXT NOT NULL, points INTEGER NOT NULL, "
+                            "PRIMARY KEY (guild_id, user_id)) WITHOUT ROWID")
+            # highest first, ties broken by the lowest user id like the ledger backend. replaces the old
+            # points_leaderboard index, which broke ties the other way
+            self.db.execute("DROP INDEX IF EXISTS points_leaderboard")
+            self.db.execute("CREATE INDEX IF NOT EXISTS points_ranking ON points (guild_id, points DESC, user_id)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS transactions ("
+                            "seq INTEGER PRIMARY KEY AUTOINCREMENT, ts INTEGER NOT NULL, guild_id TEXT NOT NULL, "
+                            "user_id TEXT NOT NULL, delta INTEGER NOT NULL, balance INTEGER NOT NULL, "
+                            "reason TEXT NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS transactions_user ON transactions (guild_id, user_id, seq)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            # databases from before transactions were pruned can still hold every transaction ever made
+            self.db.execute("DELETE FROM transactions WHERE seq IN (SELECT seq FROM (SELECT seq, ROW_NUMBER() OVER ("
+                            "PARTITION BY guild_id, user_id ORDER BY seq DESC) AS n FROM transactions) WHERE n > ?)",
+                            (self.history_size,))
+
+        self.migrate_json()
+
+    def migrate_json(self):
+        # only ever migrate once
+        if self.db.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return
+
+        # read the ledger backend's files as they are, without changing any of them
+        data = self.read_shards()
+        history = {}
+        for path in (self.ledger_file + ".1", self.ledger_file):
+            for entry in self.read_ledger(path):
+                data.setdefault(entry["guild"], {})[entry["user"]] = clamp_points(entry["balance"])
+                key = (entry["guild"], entry["user"])
+                if key not in history:
+                    history[key] = deque(maxlen=self.history_size)
+                history[key].append(entry)
+        history = sorted((entry for entries in history.values() for entry in entries), key=lambda x: x["seq"])
+
+        # copy everything over in a single transaction
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO points (guild_id, user_id, points) VALUES (?, ?, ?)",
+                                ((guild_id, user_id, clamp_points(points)) for guild_id, users in data.items()
+                                 for user_id, points in users.items()))
+            self.db.executemany("INSERT INTO transactions (ts, guild_id, user_id, delta, balance, reason) "
+                                "VALUES (?, ?, ?, ?, ?, ?)",
+                                ((x["ts"], x["guild"], x["user"], x["delta"], x["balance"], x["reason"])
+                                 for x in history))
+            self.db.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (str(int(time.time())),))
+
+    def read_shards(self):
+        # guild id -> balances from the shards, or from the single file used before shards
+        data = {}
+        if not os.path.exists(self.shard_dir):
+            if os.path.exists(self.legacy_file):
+                with open(self.legacy_file, "r") as f:
+                    data = json.load(f)
+            return data
+
+        for file_name in os.listdir(self.shard_dir):
+            path = os.path.join(self.shard_dir, file_name)
+            if file_name.endswith(".bin"):
+                try:
+                    snapshot = GuildSnapshot(path)
+                except ValueError as e:
+                    print(f"Error reading {path}, not migrating it:", e)
+                    continue
+                data[file_name[:-len(".bin")]] = snapshot.to_dict()
+                snapshot.close()
+            elif file_name.endswith(".json"):
+                # shards from before the binary snapshots
+                with open(path, "r") as f:
+                    data[file_name[:-len(".json")]] = json.load(f)
+        return data
+
+    def read_ledger(self, path):
+        # the entries of a ledger file, up to the first one that can't be read (a torn last line)
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    return
+                if not line.endswith(b"\n"):
+                    return
+                yield entry
+
+    async def run(self, func, *args):
+        # run a query on the database thread without blocking the event loop
+        self.queries += 1
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def balance(self, guild_id, user_id):
+        row = self.db.execute("SELECT points FROM points WHERE guild_id = ? AND user_id = ?",
+                              (guild_id, user_id)).fetchone()
+        return row[0] if row else 0
+
+    def record(self, guild_id, user_id, delta, reason):
+        # must be called inside a transaction. balances stop at what an sqlite integer can hold, the same limit as
+        # the ledger backend
+        old_balance = self.balance(guild_id, user_id)
+        balance = clamp_points(old_balance + delta)
+        delta = balance - old_balance
+        self.db.execute("INSERT OR REPLACE INTO points (guild_id, user_id, points) VALUES (?, ?, ?)",
+                        (guild_id, user_id, balance))
+        self.db.execute("INSERT INTO transactions (ts, guild_id, user_id, delta, balance, reason) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", (int(time.time()), guild_id, user_id, delta, balance, reason))
+        # drop the user's transactions beyond the most recent ones
+        self.db.execute("DELETE FROM transactions WHERE guild_id = ? AND user_id = ? AND seq <= ("
+                        "SELECT seq FROM transactions WHERE guild_id = ? AND user_id = ? "
+                        "ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                        (guild_id, user_id, guild_id, user_id, self.history_size))
+        return balance
+
+    def do_set(self, guild_id, user_id, points, reason):
+        with self.db:
+            return self.record(guild_id, user_id, points - self.balance(guild_id, user_id), reason)
+
+    def do_add(self, guild_id, user_id, amount, reason):
+        with self.db:
+            return self.record(guild_id, user_id, amount, reason)
+
+    def do_add_many(self, guild_id, deltas, reason):
+        # one transaction for the whole batch
+        with self.db:
+            for user_id, delta in deltas.items():
+                self.record(guild_id, user_id, delta, reason)
+
+    def do_set_many(self, guild_id, balances, reason):
+        # one transaction for the whole batch
+        with self.db:
+            for user_id, points in balances.items():
+                self.record(guild_id, user_id, points - self.balance(guild_id, user_id), reason)
+
+    def do_chunk(self, guild_id, after_user_id, limit):
+        # walks the primary key, so each chunk picks up where the last one ended
+        return self.db.execute("SELECT user_id, points FROM points WHERE guild_id = ? AND user_id > ? "
+                               "ORDER BY user_id LIMIT ?", (guild_id, after_user_id, limit)).fetchall()
+
+    def do_transfer(self, guild_id, from_id, to_id, amount, reason):
+        with self.db:
+            # make sure the sender can afford it, returns None otherwise
+            if self.balance(guild_id, from_id) < amount:
+                return None
+            self.record(guild_id, from_id, -amount, reason)
+            return self.record(guild_id, to_id, amount, reason)
+
+    def do_top(self, guild_id, limit, offset):
+        # walks the ranking index in order
+        return self.db.execute("SELECT user_id, points FROM points WHERE guild_id = ? "
+                               "ORDER BY points DESC, user_id LIMIT ? OFFSET ?",
+                               (guild_id, limit, offset)).fetchall()
+
+    def do_rank(self, guild_id, user_id):
+        # returns None if the user has no points saved in this guild
+        row = self.db.execute("SELECT points FROM points WHERE guild_id = ? AND user_id = ?",
+                              (guild_id, user_id)).fetchone()
+        if row is None:
+            return None
+        return self.db.execute("SELECT COUNT(*) + 1 FROM points WHERE guild_id = ? "
+                               "AND (points > ? OR (points = ? AND user_id < ?))",
+                               (guild_id, row[0], row[0], user_id)).fetchone()[0]
+
+    def do_count(self, guild_id):
+        return self.db.execute("SELECT COUNT(*) FROM points WHERE guild_id = ?", (guild_id,)).fetchone()[0]
+
+    def do_history(self, guild_id, user_id, limit):
+        rows = self.db.execute("SELECT seq, ts, delta, balance, reason FROM transactions "
+                               "WHERE guild_id = ? AND user_id = ? ORDER BY seq DESC LIMIT ?",
+                               (guild_id, user_id, limit)).fetchall()
+        return [{"seq": seq, "ts": ts, "guild": guild_id, "user": user_id, "delta": delta, "balance": balance,
+                 "reason": reason} for seq, ts, delta, balance, reason in rows]
+
+    async def get(self, guild_id, user_id):
+        return await self.run(self.balance, guild_id, user_id)
+
+    async def top(self, guild_id, limit, offset=0):
+        return await self.run(self.do_top, guild_id, limit, offset)
+
+    async def rank(self, guild_id, user_id):
+        return await self.run(self.do_rank, guild_id, user_id)
+
+    async def count(self, guild_id):
+        return await self.run(self.do_count, guild_id)
+
+    async def get_history(self, guild_id, user_id, limit=10):
+        return await self.run(self.do_history, guild_id, user_id, limit)
+
+    async def set(self, guild_id, user_id, points, reason="set"):
+        return await self.run(self.do_set, guild_id, user_id, points, reason)
+
+    async def add(self, guild_id, user_id, amount, reason="add"):
+        return await self.run(self.do_add, guild_id, user_id, amount, reason)
+
+    async def add_many(self, guild_id, deltas, reason="add"):
+        return await self.run(self.do_add_many, guild_id, deltas, reason)
+
+    async def set_many(self, guild_id, balances, reason="set"):
+        return await self.run(self.do_set_many, guild_id, balances, reason)
+
+    async def iter_guild(self, guild_id, chunk_size=1000):
+        # yields lists of (user id, points), one query per chunk
+        after_user_id = ""
+        while True:
+            chunk = await self.run(self.do_chunk, guild_id, after_user_id, chunk_size)
+            if not chunk:
+                return
+            yield chunk
+            after_user_id = chunk[-1][0]
+
+    async def transfer(self, guild_id, from_id, to_id, amount, reason="give"):
+        return await self.run(self.do_transfer, guild_id, from_id, to_id, amount, reason)
+
+    def stats(self):
+        return {"queries": self.queries}
+
+    def close(self):
+        # close the connection on its own thread, after any queued queries
+        if self.db:
+            self.executor.submit(self.db.close).result()
+            self.db = None
+        self.executor.shutdown()
@@ -0,0 +1,515 @@
+import asyncio
+import bisect
+import itertools
+import json
+import os
+import time
+from collections import deque, OrderedDict
+from cmds.PointsSnapshot import GuildSnapshot, write_snapshot, clamp_points
+
+"""
+Storage backends for the points cog.
+Every backend exposes the same coroutines (get, top, rank, count, get_history, set, add, add_many, set_many, transfer),
+the iter_guild async generator, plus stats() and close().
+"""
+
+
+# opens the points backend selected by name ("ledger" or "sqlite")
+def open_points_store(backend=None, flush_interval=None, idle_timeout=None):
+    if backend == "sqlite":
+        from cmds.PointsSqlite import SqlitePointsStore
+        return SqlitePointsStore()
+    return LedgerPointsStore(flush_interval=float(flush_interval or 5), idle_timeout=float(idle_timeout or 3600))
+
+
+# batches larger than this rebuild the leaderboard index on next use instead of updating it user by user
+REINDEX_BATCH_SIZE = 500
+
+
+# ordered index of one guild's balances, highest first (ties broken by user id)
+class GuildLeaderboard:
+    def __init__(self, users):
+        self.keys = sorted((-points, user_id) for user_id, points in users.items())
+
+    def update(self, user_id, old_points, new_points):
+        # move the user from their old position to the new one
+        if old_points is not None:
+            del self.keys[bisect.bisect_left(self.keys, (-old_points, user_id))]
+        bisect.insort(self.keys, (-new_points, user_id))
+
+    def rank(self, user_id, points):
+        return bisect.bisect_left(self.keys, (-points, user_id)) + 1
+
+    def page(self, offset, limit):
+        return [(user_id, -points) for points, user_id in self.keys[offset:offset + limit]]
+
+
+# balances live in memory and every change is appended to a transaction ledger. a background flusher writes each
+# guild that changed to its own binary snapshot, coalescing bursts of updates, and rotates the ledger once the snapshots
+# cover it. guilds that are only read are served straight from their memory-mapped snapshot, they are only loaded into
+# memory once they change or need a leaderboard, and are dropped again once they have been idle for a while
+class LedgerPointsStore:
+    def __init__(self, shard_dir="./points", ledger_file="./points.ledger", legacy_file="./points.json",
+                 flush_interval=5.0, compact_every=1000, history_size=25, idle_timeout=3600,
+                 max_resident_users=1000000, max_mapped=256):
+        self.shard_dir = shard_dir
+        self.ledger_file = ledger_file
+        # the previous ledger is kept around after rotation for the history
+        self.rotated_ledger_file = ledger_file + ".1"
+        # single file holding every guild, used before shards
+        self.legacy_file = legacy_file
+        self.flush_interval = flush_interval
+        self.compact_every = compact_every
+        self.history_size = history_size
+        # resident guilds, least recently used first
+        self.points_data = OrderedDict()
+        self.leaderboards = {}
+        # recent transactions of the resident guilds, the others are read back from the ledgers when asked for
+        self.history = {}
+        self.seq = 0
+        self.pending = 0
+        self.ledger = None
+
+        # write-behind state
+        self.dirty = set()
+        self.flusher = None
+        self.flush_lock = asyncio.Lock()
+        self.rotation_safe = True
+        self.writes_coalesced = 0
+        self.shards_written = 0
+
+        # lazy loading state
+        self.idle_timeout = idle_timeout
+        self.max_resident_users = max_resident_users
+        self.last_used = {}
+        self.loading = {}
+        # memory-mapped snapshots of guilds that aren't loaded, least recently used first
+        self.snapshots = OrderedDict()
+        self.max_mapped = max_mapped
+        self.guild_loads = 0
+        self.guild_evictions = 0
+        self.load_time = 0.0
+
+        self.load()
+
+    def load(self):
+        # split the old single file into shards the first time
+        if not os.path.exists(self.shard_dir):
+            os.makedirs(self.shard_dir)
+            if os.path.exists(self.legacy_file):
+                with open(self.legacy_file, "r") as f:
+                    for guild_id, users in json.load(f).items():
+                        self.write_shard(guild_id, users)
+
+        # convert json shards from before the binary snapshots
+        for file_name in os.listdir(self.shard_dir):
+            if file_name.endswith(".json"):
+                json_file = os.path.join(self.shard_dir, file_name)
+                with open(json_file, "r") as f:
+                    self.write_shard(file_name[:-len(".json")], json.load(f))
+                os.remove(json_file)
+
+        # replay the rotated ledger, then the current one, on top of the shards. every entry records the resulting
+        # balance rather than just the delta, so replaying an entry a shard already covers is harmless. only the guilds
+        # in the ledger get loaded here, everything else waits until it is used
+        replayed = set()
+        for entry in self.read_ledger(self.rotated_ledger_file):
+            self.apply(entry)
+            replayed.add(entry["guild"])
+        for entry in self.read_ledger(self.ledger_file):
+            self.apply(entry)
+            replayed.add(entry["guild"])
+            self.pending += 1
+
+        # we may have gone down before the replayed guilds were flushed, write them now so the next rotation can
+        # safely replace the rotated ledger
+        self.write_shards({guild_id: self.points_data[guild_id] for guild_id in replayed})
+
+        # open the ledger for appending
+        self.ledger = open(self.ledger_file, "a")
+
+    def read_ledger(self, path):
+        # nothing to replay
+        if not os.path.exists(path):
+            return
+
+        good_offset = 0
+        with open(path, "rb") as f:
+            for line in f:
+                # a crash mid-write can leave a torn last line, stop at the first entry we can't read
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                good_offset += len(line)
+                yield entry
+
+        # drop the torn tail so new entries don't get glued onto it
+        if good_offset != os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(good_offset)
+
+    def apply(self, entry):
+        # restore the balance and remember the transaction
+        if entry["guild"] not in self.points_data:
+            self.resident(entry["guild"], self.read_shard(entry["guild"]))
+        self.points_data[entry["guild"]][entry["user"]] = clamp_points(entry["balance"])
+        self.remember(entry)
+        self.seq = max(self.seq, entry["seq"])
+
+    def remember(self, entry):
+        guild_history = self.history.setdefault(entry["guild"], {})
+        if entry["user"] not in guild_history:
+            guild_history[entry["user"]] = deque(maxlen=self.history_size)
+        guild_history[entry["user"]].append(entry)
+
+    def shard_file(self, guild_id):
+        return os.path.join(self.shard_dir, f"{guild_id}.bin")
+
+    def open_shard(self, guild_id):
+        # returns the guild's snapshot, or None if it has no points yet. a shard that can't be read is moved aside
+        # (the ledger still has the latest changes) so it doesn't take the cog down
+        shard_file = self.shard_file(guild_id)
+        try:
+            return GuildSnapshot(shard_file)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            print(f"Error reading the points of guild {guild_id}, moving it to {shard_file}.corrupt:", e)
+            os.replace(shard_file, shard_file + ".corrupt")
+            return None
+
+    def read_shard(self, guild_id):
+        # guilds without a shard have no points yet
+        snapshot = self.open_shard(guild_id)
+        if snapshot is None:
+            return {}
+        users = snapshot.to_dict()
+        snapshot.close()
+        return users
+
+    def mapped(self, guild_id):
+        # returns the memory-mapped snapshot of a guild that isn't loaded, or None if it has no points yet
+        if guild_id in self.snapshots:
+            self.snapshots.move_to_end(guild_id)
+            self.last_used[guild_id] = time.monotonic()
+            return self.snapshots[guild_id]
+        snapshot = self.open_shard(guild_id)
+        if snapshot is None:
+            return None
+        self.snapshots[guild_id] = snapshot
+        self.last_used[guild_id] = time.monotonic()
+        self.start_flusher()
+        return snapshot
+
+    def unmap(self, guild_id):
+        snapshot = self.snapshots.pop(guild_id, None)
+        if snapshot:
+            snapshot.close()
+
+    def resident(self, guild_id, users):
+        # once loaded the snapshot is out of date as soon as anything changes, so stop using it
+        self.unmap(guild_id)
+        self.points_data[guild_id] = users
+        self.last_used[guild_id] = time.monotonic()
+
+    async def load_guild(self, guild_id):
+        # returns the guild's balances, loading them first if they aren't in memory
+        users = self.points_data.get(guild_id)
+        if users is not None:
+            self.points_data.move_to_end(guild_id)
+            self.last_used[guild_id] = time.monotonic()
+            return users
+
+        # everyone asking for the same guild at once waits on a single load
+        if guild_id not in self.loading:
+            self.loading[guild_id] = asyncio.ensure_future(self.read_guild(guild_id))
+        return await asyncio.shield(self.loading[guild_id])
+
+    async def read_guild(self, guild_id):
+        try:
+            # read the shard off the event loop
+            start = time.perf_counter()
+            loop = asyncio.get_event_loop()
+            users = await loop.run_in_executor(None, self.read_shard, guild_id)
+            self.resident(guild_id, users)
+            self.guild_loads += 1
+            self.load_time += time.perf_counter() - start
+            self.start_flusher()
+            return users
+        finally:
+            del self.loading[guild_id]
+
+    def all_guilds(self):
+        # yields (guild id, balances) for every guild, resident or not, without loading them into memory
+        for guild_id, users in self.points_data.items():
+            yield guild_id, users
+        for file_name in os.listdir(self.shard_dir):
+            guild_id = file_name[:-len(".bin")]
+            if file_name.endswith(".bin") and guild_id not in self.points_data:
+                yield guild_id, self.read_shard(guild_id)
+
+    def evict(self):
+        # drop guilds that have been idle too long, and the least recently used ones while we are over the memory
+        # cap. guilds that still have to be flushed stay
+        now = time.monotonic()
+        resident_users = sum(len(users) for users in self.points_data.values())
+        for guild_id in list(self.points_data):
+            idle = now - self.last_used[guild_id] > self.idle_timeout
+            if not idle and resident_users <= self.max_resident_users:
+                break
+            if guild_id in self.dirty:
+                continue
+            resident_users -= len(self.points_data.pop(guild_id))
+            del self.last_used[guild_id]
+            self.leaderboards.pop(guild_id, None)
+            self.history.pop(guild_id, None)
+            self.guild_evictions += 1
+
+        # unmap snapshots that have been idle too long, or the least recently used ones while too many are mapped
+        for guild_id in list(self.snapshots):
+            if now - self.last_used[guild_id] <= self.idle_timeout and len(self.snapshots) <= self.max_mapped:
+                break
+            self.unmap(guild_id)
+            del self.last_used[guild_id]
+
+    def record(self, guild_id, user_id, delta, reason):
+        # update the balance in memory, the guild must already be loaded
+        guild_points = self.points_data[guild_id]
+        old_balance = guild_points.get(user_id)
+        # balances stop at what a snapshot can hold
+        balance = clamp_points((old_balance or 0) + delta)
+        delta = balance - (old_balance or 0)
+        guild_points[user_id] = balance
+
+        # keep the leaderboard index in step if this guild has one
+        if guild_id in self.leaderboards:
+            self.leaderboards[guild_id].update(user_id, old_balance, balance)
+
+        # append the transaction to the ledger
+        self.seq += 1
+        entry = {"seq": self.seq, "ts": int(time.time()), "guild": guild_id, "user": user_id, "delta": delta,
+                 "balance": balance, "reason": reason}
+        self.ledger.write(json.dumps(entry) + "\n")
+        self.remember(entry)
+        self.pending += 1
+
+        # the guild gets written by the next flush, count the update as coalesced if it was already waiting
+        if guild_id in self.dirty:
+            self.writes_coalesced += 1
+        else:
+            self.dirty.add(guild_id)
+        return balance
+
+    def balance(self, guild_id, user_id):
+        return self.points_data.get(guild_id, {}).get(user_id, 0)
+
+    def leaderboard(self, guild_id):
+        # build the index the first time this guild's leaderboard is needed, after that it is updated in place
+        if guild_id not in self.leaderboards:
+            self.leaderboards[guild_id] = GuildLeaderboard(self.points_data.get(guild_id, {}))
+        return self.leaderboards[guild_id]
+
+    async def get(self, guild_id, user_id):
+        # read straight from the snapshot unless the guild is loaded
+        if guild_id not in self.points_data:
+            snapshot = self.mapped(guild_id)
+            return snapshot.get(user_id) if snapshot else 0
+        users = await self.load_guild(guild_id)
+        return users.get(user_id, 0)
+
+    async def top(self, guild_id, limit, offset=0):
+        await self.load_guild(guild_id)
+        return self.leaderboard(guild_id).page(offset, limit)
+
+    async def rank(self, guild_id, user_id):
+        # returns None if the user has no points saved in this guild
+        users = await self.load_guild(guild_id)
+        points = users.get(user_id)
+        if points is None:
+            return None
+        return self.leaderboard(guild_id).rank(user_id, points)
+
+    async def count(self, guild_id):
+        # read straight from the snapshot unless the guild is loaded
+        if guild_id not in self.points_data:
+            snapshot = self.mapped(guild_id)
+            return len(snapshot) if snapshot else 0
+        users = await self.load_guild(guild_id)
+        return len(users)
+
+    async def get_history(self, guild_id, user_id, limit=10):
+        # most recent first
+        entries = self.history.get(guild_id, {}).get(user_id)
+        if entries is None:
+            # nothing since the guild was loaded, look through the ledgers off the event loop
+            loop = asyncio.get_event_loop()
+            entries = await loop.run_in_executor(None, self.scan_history, guild_id, user_id)
+        return list(reversed(entries))[:limit]
+
+    def scan_history(self, guild_id, user_id):
+        # the user's most recent transactions in the rotated and current ledger, oldest first
+        entries = deque(maxlen=self.history_size)
+        for path in (self.rotated_ledger_file, self.ledger_file):
+            try:
+                with open(path, "rb") as f:
+                    for line in f:
+                        # skip anything we can't read, such as a line that is still being written
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue
+                        if entry["guild"] == guild_id and entry["user"] == user_id:
+                            entries.append(entry)
+            except FileNotFoundError:
+                continue
+        return entries
+
+    async def set(self, guild_id, user_id, points, reason="set"):
+        await self.load_guild(guild_id)
+        balance = self.record(guild_id, user_id, points - self.balance(guild_id, user_id), reason)
+        self.commit()
+        return balance
+
+    async def add(self, guild_id, user_id, amount, reason="add"):
+        await self.load_guild(guild_id)
+        balance = self.record(guild_id, user_id, amount, reason)
+        self.commit()
+        return balance
+
+    async def add_many(self, guild_id, deltas, reason="add"):
+        await self.load_guild(guild_id)
+
+        # large batches are cheaper to re-sort once than to insert one by one
+        if len(deltas) > REINDEX_BATCH_SIZE:
+            self.leaderboards.pop(guild_id, None)
+
+        # every entry goes into the same ledger write and the guild is only flushed once
+        for user_id, delta in deltas.items():
+            self.record(guild_id, user_id, delta, reason)
+        self.commit()
+
+    async def set_many(self, guild_id, balances, reason="set"):
+        await self.load_guild(guild_id)
+        await self.add_many(guild_id, {user_id: points - self.balance(guild_id, user_id)
+                                       for user_id, points in balances.items()}, reason)
+
+    async def iter_guild(self, guild_id, chunk_size=1000):
+        # yields lists of (user id, points). nothing in here awaits, so as long as the caller doesn't await between
+        # chunks either the guild can't change underneath us
+        if guild_id not in self.points_data:
+            # read straight from the snapshot
+            snapshot = self.mapped(guild_id)
+            for start in range(0, len(snapshot) if snapshot else 0, chunk_size):
+                yield snapshot.chunk(start, chunk_size)
+            return
+
+        users = iter(self.points_data[guild_id].items())
+        while True:
+            chunk = list(itertools.islice(users, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    async def transfer(self, guild_id, from_id, to_id, amount, reason="give"):
+        await self.load_guild(guild_id)
+
+        # make sure the sender can afford it, returns None otherwise
+        if self.balance(guild_id, from_id) < amount:
+            return None
+
+        self.record(guild_id, from_id, -amount, reason)
+        balance = self.record(guild_id, to_id, amount, reason)
+        self.commit()
+        return balance
+
+    def commit(self):
+        # push the new entries to disk, the shards are written later by the flusher
+        self.ledger.flush()
+
+        self.start_flusher()
+
+    def start_flusher(self):
+        # start the flusher the first time a guild is used
+        if self.flusher is None:
+            self.flusher = asyncio.get_event_loop().create_task(self.flush_loop())
+
+    async def flush_loop(self):
+        # everything that changes within one interval is written together, then idle guilds are dropped
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # keep going whatever happens, the guilds that weren't written are tried again next time
+            try:
+                await self.flush()
+            except Exception as e:
+                print("Error flushing points:", e)
+            self.evict()
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.dirty:
+                return
+
+            # rotate the ledger and copy the dirty guilds together, without yielding in between, so this flush covers
+            # everything the rotated ledger contains. only rotate if the last flush made it to disk, otherwise the
+            # rotated ledger would still be needed
+            if self.pending >= self.compact_every and self.rotation_safe:
+                self.ledger.close()
+                os.replace(self.ledger_file, self.rotated_ledger_file)
+                self.ledger = open(self.ledger_file, "a")
+                self.pending = 0
+            shards = {guild_id: dict(self.points_data[guild_id]) for guild_id in self.dirty}
+            self.dirty.clear()
+
+            # serialize and write the shards off the event loop, guilds that couldn't be written are tried again on the
+            # next flush and keep the rotated ledger around until they are
+            try:
+                loop = asyncio.get_event_loop()
+                failed = await loop.run_in_executor(None, self.write_shards, shards)
+            except Exception:
+                failed = set(shards)
+                raise
+            finally:
+                self.dirty.update(failed)
+                self.rotation_safe = not failed
+
+    def write_shards(self, shards):
+        # returns the guilds that couldn't be written, one bad guild doesn't stop the others
+        failed = set()
+        for guild_id, users in shards.items():
+            try:
+                self.write_shard(guild_id, users)
+            except Exception as e:
+                print(f"Error writing the points of guild {guild_id}:", e)
+                failed.add(guild_id)
+        return failed
+
+    def write_shard(self, guild_id, users):
+        write_snapshot(self.shard_file(guild_id), users)
+        self.shards_written += 1
+
+    def stats(self):
+        average_load = self.load_time / self.guild_loads * 1000 if self.guild_loads else 0
+        return {"resident guilds": len(self.points_data), "mapped guilds": len(self.snapshots),
+                "resident users": sum(len(users) for users in self.points_data.values()),
+                "guild loads": self.guild_loads, "average guild load (ms)": round(average_load, 2),
+                "guild evictions": self.guild_evictions, "dirty guilds": len(self.dirty),
+                "shards written": self.shards_written, "writes coalesced": self.writes_coalesced,
+                "ledger entries": self.pending}
+
+    def close(self):
+        # stop the flusher and write whatever is still dirty
+        if self.flusher:
+            self.flusher.cancel()
+            self.flusher = None
+        self.write_shards({guild_id: self.points_data[guild_id] for guild_id in self.dirty})
+        self.dirty.clear()
+
+        if self.ledger:
+            self.ledger.close()
+            self.ledger = None
+
+        for guild_id in list(self.snapshots):
+            self.unmap(guild_id)
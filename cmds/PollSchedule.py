@@ -0,0 +1,127 @@
+import json
+import math
+import os
+import random
+import time
+
+"""
+Decides when each Twitch broadcaster is polled next.
+Broadcasters get their own jittered interval based on their history: often around the hours they usually go live,
+rarely when they haven't streamed in a long time. Polls are limited by a request budget per minute, broadcasters that
+don't fit in the budget stay due and go first next time.
+"""
+
+# seconds between polls
+USUAL_HOURS_INTERVAL = 60
+RECENTLY_LIVE_INTERVAL = 180
+DEFAULT_INTERVAL = 300
+OFFLINE_INTERVAL = 600
+LONG_OFFLINE_INTERVAL = 1800
+# broadcasters whose go-live is pushed by eventsub are only polled in case a notification gets lost
+PUSHED_INTERVAL = 1800
+# seconds before polling broadcasters again after a failed poll
+RETRY_INTERVAL = 30
+# how far the interval is randomly stretched or shortened, so broadcasters don't end up polled in lockstep
+JITTER = 0.2
+SECONDS_PER_DAY = 86400
+
+
+class PollSchedule:
+    def __init__(self, budget_per_minute=60, batch_size=100, history_file="./twitch_schedule.json"):
+        self.budget_per_minute = budget_per_minute
+        self.batch_size = batch_size
+        self.history_file = history_file
+        # login -> time of the next poll
+        self.next_poll = {}
+        self.live = set()
+        # broadcasters covered by eventsub subscriptions
+        self.pushed = set()
+        # login -> {"last_live": time, "hours": go-live count per hour of the day (UTC)}
+        self.history = {}
+        self.dirty = False
+        self.tokens = budget_per_minute
+        self.refilled_at = time.time()
+        self.deferred = 0
+        self.failed = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.history_file, "r") as f:
+                self.history = json.load(f)
+        except FileNotFoundError:
+            self.history = {}
+
+    def save(self):
+        if not self.dirty:
+            return
+        # write to a temporary file and swap it in so a crash never leaves a half written file
+        with open(self.history_file + ".tmp", "w") as f:
+            json.dump(self.history, f)
+        os.replace(self.history_file + ".tmp", self.history_file)
+        self.dirty = False
+
+    def sync(self, logins, now):
+        # start polling new broadcasters right away and forget the ones no guild follows anymore
+        for login in logins:
+            self.next_poll.setdefault(login, now)
+        for login in set(self.next_poll) - set(logins):
+            del self.next_poll[login]
+            self.live.discard(login)
+
+    def interval(self, login, now):
+        if login in self.pushed:
+            return PUSHED_INTERVAL
+        history = self.history.get(login)
+        if login in self.live or history is None:
+            return DEFAULT_INTERVAL
+
+        # poll often if they usually go live in this hour or the next one
+        hour = time.gmtime(now).tm_hour
+        if history["hours"][hour] + history["hours"][(hour + 1) % 24] >= 2:
+            return USUAL_HOURS_INTERVAL
+
+        offline = now - history["last_live"]
+        if offline < SECONDS_PER_DAY:
+            return RECENTLY_LIVE_INTERVAL
+        if offline < 7 * SECONDS_PER_DAY:
+            return OFFLINE_INTERVAL
+        return LONG_OFFLINE_INTERVAL
+
+    def take_due(self, now):
+        # the broadcasters to poll now, most overdue first, as many as the budget allows
+        self.tokens = min(self.budget_per_minute,
+                          self.tokens + max(0, now - self.refilled_at) * self.budget_per_minute / 60)
+        self.refilled_at = now
+        due = sorted((login for login, next_poll in self.next_poll.items() if next_poll <= now),
+                     key=self.next_poll.get)
+        requests = min(int(self.tokens), math.ceil(len(due) / self.batch_size))
+        self.tokens -= requests
+        self.deferred += max(0, len(due) - requests * self.batch_size)
+        return due[:requests * self.batch_size]
+
+    def update(self, logins, live_streams, now):
+        # record the results of a poll and schedule the next one
+        for login in logins:
+            if login in live_streams:
+                history = self.history.setdefault(login, {"last_live": now, "hours": [0] * 24})
+                if login not in self.live:
+                    # just went live
+                    history["hours"][time.gmtime(now).tm_hour] += 1
+                    self.live.add(login)
+                history["last_live"] = now
+                self.dirty = True
+            else:
+                self.live.discard(login)
+            self.next_poll[login] = now + self.interval(login, now) * random.uniform(1 - JITTER, 1 + JITTER)
+
+    def retry(self, logins, now):
+        # a poll failed, we learned nothing about these broadcasters so keep their state and poll them again soon
+        self.failed += len(logins)
+        for login in logins:
+            if login in self.next_poll:
+                self.next_poll[login] = now + RETRY_INTERVAL * random.uniform(1 - JITTER, 1 + JITTER)
+
+    def stats(self):
+        return {"broadcasters": len(self.next_poll), "live": len(self.live), "polls deferred by budget": self.deferred,
+                "failed polls": self.failed}
@@ -0,0 +1,122 @@
+import asyncio
+import heapq
+import json
+import os
+import time
+
+"""
+Keeps track of the active raffle in every guild.
+A single task sleeps until the next raffle is due instead of one polling loop per raffle, and the raffles are saved to
+disk so they resume after a restart.
+"""
+
+
+class RaffleScheduler:
+    def __init__(self, on_end, raffles_file="./raffles.json", save_delay=1.0):
+        # coroutine called with (guild_id, raffle) when a raffle is over
+        self.on_end = on_end
+        self.raffles_file = raffles_file
+        self.save_delay = save_delay
+        self.raffles = {}
+        # heap of (end time, guild id), entries for raffles that no longer exist are skipped when popped
+        self.heap = []
+        self.wakeup = asyncio.Event()
+        self.save_task = None
+        # set when something changed that isn't written yet
+        self.dirty = False
+
+        self.load()
+
+    def load(self):
+        # load any raffles that were running when we went down
+        if os.path.exists(self.raffles_file):
+            with open(self.raffles_file, "r") as f:
+                for guild_id, raffle in json.load(f).items():
+                    raffle["participants"] = set(raffle["participants"])
+                    self.raffles[guild_id] = raffle
+                    heapq.heappush(self.heap, (raffle["end_time"], guild_id))
+
+    def snapshot(self):
+        return {guild_id: {**raffle, "participants": list(raffle["participants"])}
+                for guild_id, raffle in self.raffles.items()}
+
+    def save(self, data=None):
+        if data is None:
+            data = self.snapshot()
+
+        # write to a temporary file and swap it in so a crash never leaves a half written file
+        tmp_file = self.raffles_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_file, self.raffles_file)
+
+    def schedule_save(self):
+        # changes come in bursts, so gather them into one write. a save that is already running picks up the change
+        self.dirty = True
+        if self.save_task is None or self.save_task.done():
+            self.save_task = asyncio.get_event_loop().create_task(self.delayed_save())
+
+    async def delayed_save(self):
+        # keep going until a write covers every change, including ones made while the last write was running
+        while self.dirty:
+            await asyncio.sleep(self.save_delay)
+
+            # copy the raffles here, then serialize and write them off the event loop
+            self.dirty = False
+            data = self.snapshot()
+            loop = asyncio.get_event_loop()
+            try:
+                await loop.run_in_executor(None, self.save, data)
+            except OSError as e:
+                print("Error saving raffles:", e)
+
+    def get(self, guild_id):
+        return self.raffles.get(guild_id)
+
+    def create(self, guild_id, channel_id, amount, duration):
+        end_time = time.time() + duration
+        self.raffles[guild_id] = {"amount": amount, "end_time": end_time, "channel_id": channel_id,
+                                  "participants": set()}
+        self.schedule_save()
+
+        # wake the scheduler up if this raffle ends before everything else
+        heapq.heappush(self.heap, (end_time, guild_id))
+        self.wakeup.set()
+
+    def join(self, guild_id, user_id):
+        # returns False if the user already joined
+        participants = self.raffles[guild_id]["participants"]
+        if user_id in participants:
+            return False
+        participants.add(user_id)
+        self.schedule_save()
+        return True
+
+    async def run(self):
+        while True:
+            # wait until the next raffle is due, or until a new raffle is created
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            # end every raffle that is due
+            while self.heap and self.heap[0][0] <= time.time():
+                end_time, guild_id = heapq.heappop(self.heap)
+                raffle = self.raffles.get(guild_id)
+                if raffle is None or raffle["end_time"] != end_time:
+                    continue
+                del self.raffles[guild_id]
+                self.schedule_save()
+
+                # announce in the background so a slow guild doesn't hold up the rest
+                asyncio.get_event_loop().create_task(self.finish(guild_id, raffle))
+
+    async def finish(self, guild_id, raffle):
+        try:
+            await self.on_end(guild_id, raffle)
+        except Exception as e:
+            print(f"Error ending raffle for guild {guild_id}:", e)
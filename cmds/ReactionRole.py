@@ -2,19 +2,59 @@ import discord
 from discord.ext import commands
 from discord_slash import cog_ext, SlashContext
 from discord_slash.utils.manage_commands import create_option
+import copy
 import json
 import os
+from cmds.RestQueue import get_rest_queue
+from cmds.RoleBatcher import RoleBatcher
+from cmds.RoleReconciler import RoleReconciler
 
 
 class ReactionRoles(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        # outbound requests go through the bot-wide queue
+        self.rest = get_rest_queue(bot)
         self.reaction_roles_dir = "ReactionRoles"
+        # guild_id -> {message_id: [{"emoji": ..., "role_id": ...}]}, same layout as the files
+        self.reaction_roles = {}
+        # (guild_id, message_id, emoji) -> role_id, and every message that has reaction roles
+        self.index = {}
+        self.indexed_messages = set()
+        # Role changes from reactions are applied in batches per member
+        self.role_batcher = RoleBatcher(bot)
+        # Catches up on reactions that changed while the bot was offline
+        self.reconciler = RoleReconciler(bot, self.role_batcher)
+        # on_ready happens again after every reconnect, the startup pass only runs once
+        self.reconciled_on_startup = False
 
         # Ensure ReactionRoles directory exists
         if not os.path.exists(self.reaction_roles_dir):
             os.makedirs(self.reaction_roles_dir)
 
+        # Load every guild's reaction roles once
+        for file_name in os.listdir(self.reaction_roles_dir):
+            if file_name.endswith(".json"):
+                with open(f"{self.reaction_roles_dir}/{file_name}", "r") as file:
+                    self.reaction_roles[file_name[:-len(".json")]] = json.load(file)
+        self.rebuild_index()
+
+    def rebuild_index(self):
+        # Build the lookup used by the reaction listeners
+        self.index = {}
+        for guild_id, reaction_roles in self.reaction_roles.items():
+            for message_id, entries in reaction_roles.items():
+                for reaction_role in entries:
+                    self.index[(int(guild_id), int(message_id), reaction_role["emoji"])] = int(reaction_role["role_id"])
+        self.indexed_messages = {message_id for _, message_id, _ in self.index}
+
+    def save_reaction_roles(self, guild_id, reaction_roles):
+        # Save the updated reaction role data and refresh the index
+        self.reaction_roles[guild_id] = reaction_roles
+        with open(f"{self.reaction_roles_dir}/{guild_id}.json", "w") as file:
+            json.dump(reaction_roles, file)
+        self.rebuild_index()
+
     @cog_ext.cog_subcommand(
         base="reactionrole",
         name="add",
@@ -42,21 +82,17 @@ class ReactionRoles(commands.Cog):
     )
     @commands.has_permissions(manage_guild=True)
     async def add_reaction_role(self, ctx: SlashContext, emoji: str, role: discord.Role, message_id: int):
-        await ctx.defer(hidden=True)
+        await self.rest.defer(ctx, hidden=True)
         guild_id = str(ctx.guild.id)
-        # Load existing reaction roles data or create a new dictionary
-        try:
-            with open(f"{self.reaction_roles_dir}/{guild_id}.json", "r") as file:
-                reaction_roles = json.load(file)
-        except FileNotFoundError:
-            reaction_roles = {}
+        # Get a copy of the existing reaction roles data or create a new dictionary
+        reaction_roles = copy.deepcopy(self.reaction_roles.get(guild_id, {}))
 
         # Get the message object from the message ID
         try:
             message = await ctx.channel.fetch_message(message_id)
         except discord.NotFound:
-            await ctx.send("> The specified message does not exist for this channel. (hint: use this command in the "
-                           "same channel as the message!)", hidden=True)
+            await self.rest.respond(ctx, "> The specified message does not exist for this channel. (hint: use this "
+                                    "command in the same channel as the message!)", hidden=True)
             return
 
         # Check if the emoji is already a reaction to the message
@@ -66,32 +102,135 @@ class ReactionRoles(commands.Cog):
                     old_role = ctx.guild.get_role(int(reaction_role["role_id"]))
                     if old_role:
                         if old_role == role:
-                            await ctx.send("> The specified emoji is already assigned to the same role!", hidden=True)
+                            await self.rest.respond(ctx, "> The specified emoji is already assigned to the same role!",
+                                                    hidden=True)
                             return
                         else:
                             # remove old role from dictionary
-                            await message.clear_reaction(emoji)
+                            await self.rest.clear_reactions(message, emoji)
                             reaction_roles[str(message_id)].remove(reaction_role)
 
         # Add the reaction to the message
         # Get the message object from the message ID
         try:
-            await message.add_reaction(emoji)
+            await self.rest.react(message, emoji)
         except discord.NotFound:
-            await ctx.send("> The specified emoji does not exist for this server.", hidden=True)
+            await self.rest.respond(ctx, "> The specified emoji does not exist for this server.", hidden=True)
             return
 
         # Append the new reaction role to the existing ones for this message
         message_id = str(message_id)
         if message_id not in reaction_roles:
             reaction_roles[message_id] = []
-        reaction_roles[message_id].append({"emoji": emoji, "role_id": str(role.id)})
+        reaction_roles[message_id].append({"emoji": emoji, "role_id": str(role.id),
+                                           "channel_id": str(message.channel.id)})
 
         # Save the updated reaction role data
-        with open(f"{self.reaction_roles_dir}/{guild_id}.json", "w") as file:
-            json.dump(reaction_roles, file)
+        self.save_reaction_roles(guild_id, reaction_roles)
+
+        await self.rest.respond(ctx, "> The reaction role has been successfully added!", hidden=True)
+
+    def parse_pairs(self, guild, pairs):
+        # Parse "emoji role, emoji role, ..." into a list of (emoji, role), raises ValueError if any pair is invalid
+        parsed = []
+        for pair in pairs.replace("\n", ",").split(","):
+            pair = pair.strip()
+            if not pair:
+                continue
+            parts = pair.split(maxsplit=1)
+            if len(parts) != 2:
+                raise ValueError(f"`{pair}` needs an emoji and a role")
+            emoji, role_text = parts[0], parts[1].strip()
+
+            # Custom emojis have to be from a server the bot is in
+            if emoji.startswith("<") and emoji.endswith(">"):
+                emoji_id = emoji.rstrip(">").rsplit(":", 1)[-1]
+                if not emoji_id.isdigit() or self.bot.get_emoji(int(emoji_id)) is None:
+                    raise ValueError(f"{emoji} is not an emoji I can use")
+
+            # The role can be a mention, an ID or a name
+            role_id = role_text.strip("<@&>")
+            role = guild.get_role(int(role_id)) if role_id.isdigit() else discord.utils.get(guild.roles, name=role_text)
+            if role is None:
+                raise ValueError(f"`{role_text}` is not a role in this server")
+            if any(emoji == other for other, _ in parsed):
+                raise ValueError(f"{emoji} is used more than once")
+            parsed.append((emoji, role))
+
+        if not parsed:
+            raise ValueError("no emoji/role pairs were given")
+        return parsed
+
+    @cog_ext.cog_subcommand(
+        base="reactionrole",
+        name="bulk",
+        description="Add several reaction roles to a message at once",
+        options=[
+            create_option(
+                name="message_id",
+                description="The message ID of the message on which the reactions will be added",
+                option_type=3,
+                required=True
+            ),
+            create_option(
+                name="pairs",
+                description="Emoji and role pairs separated by commas, e.g. 🔴 @Red, 🔵 @Blue",
+                option_type=3,
+                required=True
+            )
+        ]
+    )
+    @commands.has_permissions(manage_guild=True)
+    async def bulk_reaction_roles(self, ctx: SlashContext, message_id: str, pairs: str):
+        await self.rest.defer(ctx, hidden=True)
+        guild_id = str(ctx.guild.id)
+
+        # Validate every pair before touching the message
+        try:
+            pairs = self.parse_pairs(ctx.guild, pairs)
+        except ValueError as e:
+            await self.rest.respond(ctx, f"> Invalid reaction roles: {e}", hidden=True)
+            return
+
+        # Get the message object from the message ID, once for every pair
+        try:
+            message = await ctx.channel.fetch_message(int(message_id))
+        except (ValueError, discord.NotFound):
+            await self.rest.respond(ctx, "> The specified message does not exist for this channel. (hint: use this "
+                                    "command in the same channel as the message!)", hidden=True)
+            return
 
-        await ctx.send("> The reaction role has been successfully added!", hidden=True)
+        reaction_roles = copy.deepcopy(self.reaction_roles.get(guild_id, {}))
+        message_id = str(message.id)
+        entries = reaction_roles.setdefault(message_id, [])
+        existing = {entry["emoji"]: entry for entry in entries}
+
+        # Add the reactions one after the other so they keep the order they were given in
+        added, failed = [], []
+        for emoji, role in pairs:
+            old = existing.get(emoji)
+            if old and old["role_id"] == str(role.id):
+                continue
+            try:
+                if old:
+                    # The emoji gave a different role, start it over
+                    await self.rest.clear_reactions(message, emoji)
+                    entries.remove(old)
+                await self.rest.react(message, emoji)
+            except discord.HTTPException:
+                failed.append(emoji)
+                continue
+            entries.append({"emoji": emoji, "role_id": str(role.id), "channel_id": str(message.channel.id)})
+            added.append(f"> {emoji} → {role.mention}")
+
+        # Save every new reaction role with a single write
+        if added:
+            self.save_reaction_roles(guild_id, reaction_roles)
+
+        response = "\n".join(added) if added else "> No new reaction roles were added."
+        if failed:
+            response += f"\n> Could not add: {' '.join(failed)}"
+        await self.rest.respond(ctx, response, hidden=True)
 
     @cog_ext.cog_subcommand(
         base="reactionrole",
@@ -114,46 +253,44 @@ class ReactionRoles(commands.Cog):
     )
     @commands.has_permissions(manage_guild=True)
     async def remove_reaction_role(self, ctx: SlashContext, emoji: str, message_id: int):
-        await ctx.defer(hidden=True)
+        await self.rest.defer(ctx, hidden=True)
         guild_id = str(ctx.guild.id)
-        # Load existing reaction roles data or return if file not found
-        try:
-            with open(f"{self.reaction_roles_dir}/{guild_id}.json", "r") as file:
-                reaction_roles = json.load(file)
-        except FileNotFoundError:
-            await ctx.send("> No reaction roles found for this server.", hidden=True)
+        # Get existing reaction roles data or return if there is none
+        if guild_id not in self.reaction_roles:
+            await self.rest.respond(ctx, "> No reaction roles found for this server.", hidden=True)
             return
+        reaction_roles = copy.deepcopy(self.reaction_roles[guild_id])
 
         # Get the message object from the message ID
         try:
             message = await ctx.channel.fetch_message(message_id)
         except discord.NotFound:
-            await ctx.send("> The specified message does not exist for this channel. (hint: use this command in the "
-                           "same channel as the message!)", hidden=True)
+            await self.rest.respond(ctx, "> The specified message does not exist for this channel. (hint: use this "
+                                    "command in the same channel as the message!)", hidden=True)
             return
 
         # Check if the message has any reaction roles associated with it
         if message_id not in reaction_roles:
-            await ctx.send("> No reaction roles found for the specified message.", hidden=True)
+            await self.rest.respond(ctx, "> No reaction roles found for the specified message.", hidden=True)
             return
 
         # Check if the specified emoji is a reaction to the message
         for reaction_role in reaction_roles[message_id]:
             if reaction_role["emoji"] == emoji:
                 # Remove the reaction from the message
-                await message.clear_reaction(emoji)
+                await self.rest.clear_reactions(message, emoji)
                 # Remove the reaction role from the list
                 reaction_roles[message_id].remove(reaction_role)
                 break
         else:
-            await ctx.send("> The specified emoji is not assigned to any role for this message.", hidden=True)
+            await self.rest.respond(ctx, "> The specified emoji is not assigned to any role for this message.",
+                                    hidden=True)
             return
 
         # Save the updated reaction role data
-        with open(f"{self.reaction_roles_dir}/{guild_id}.json", "w") as file:
-            json.dump(reaction_roles, file)
+        self.save_reaction_roles(guild_id, reaction_roles)
 
-        await ctx.send("> The reaction role has been successfully removed!", hidden=True)
+        await self.rest.respond(ctx, "> The reaction role has been successfully removed!", hidden=True)
 
     @cog_ext.cog_subcommand(
         base="reactionrole",
@@ -170,85 +307,140 @@ class ReactionRoles(commands.Cog):
     )
     @commands.has_permissions(manage_guild=True)
     async def clear_reaction_roles(self, ctx: SlashContext, message_id: int):
-        await ctx.defer(hidden=True)
+        await self.rest.defer(ctx, hidden=True)
         guild_id = str(ctx.guild.id)
-        # Load existing reaction roles data or return if file not found
-        try:
-            with open(f"{self.reaction_roles_dir}/{guild_id}.json", "r") as file:
-                reaction_roles = json.load(file)
-        except FileNotFoundError:
-            await ctx.send("> No reaction roles found for this guild.", hidden=True)
+        # Get existing reaction roles data or return if there is none
+        if guild_id not in self.reaction_roles:
+            await self.rest.respond(ctx, "> No reaction roles found for this guild.", hidden=True)
             return
+        reaction_roles = copy.deepcopy(self.reaction_roles[guild_id])
 
         # Get the message object from the message ID
         try:
             message = await ctx.channel.fetch_message(message_id)
         except discord.NotFound:
-            await ctx.send("> The specified message does not exist for this channel. (hint: use this command in the "
-                           "same channel as the message!)", hidden=True)
+            await self.rest.respond(ctx, "> The specified message does not exist for this channel. (hint: use this "
+                                    "command in the same channel as the message!)", hidden=True)
             return
 
         # Check if the message has any reaction roles associated with it
         if message_id not in reaction_roles:
-            await ctx.send("> No reaction roles found for the specified message.", hidden=True)
+            await self.rest.respond(ctx, "> No reaction roles found for the specified message.", hidden=True)
             return
 
         # Remove all reactions from the message
-        await message.clear_reactions()
+        await self.rest.clear_reactions(message)
 
         # Remove all reaction roles associated with the message
         del reaction_roles[message_id]
 
         # Save the updated reaction role data
-        with open(f"{self.reaction_roles_dir}/{guild_id}.json", "w") as file:
-            json.dump(reaction_roles, file)
+        self.save_reaction_roles(guild_id, reaction_roles)
 
-        await ctx.send("> The reaction role(s) have been successfully cleared!", hidden=True)
+        await self.rest.respond(ctx, "> The reaction role(s) have been successfully cleared!", hidden=True)
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload):
-        if payload.member.bot:
+        # Ignore reactions on messages without reaction roles
+        if payload.message_id not in self.indexed_messages:
             return
-
-        guild_id = str(payload.guild_id)
-        try:
-            with open(f"{self.reaction_roles_dir}/{guild_id}.json", "r") as file:
-                reaction_roles = json.load(file)
-        except FileNotFoundError:
+        if payload.member is None or payload.member.bot:
             return
 
-        message_id = str(payload.message_id)
-        if message_id not in reaction_roles:
+        role_id = self.index.get((payload.guild_id, payload.message_id, str(payload.emoji)))
+        if role_id is None:
             return
 
-        for reaction_role in reaction_roles[message_id]:
-            if str(payload.emoji) == reaction_role["emoji"]:
-                guild = self.bot.get_guild(payload.guild_id)
-                role = guild.get_role(int(reaction_role["role_id"]))
-                if role:
-                    await payload.member.add_roles(role)
+        # Queue the change, bursts of reactions from the same member are applied together
+        self.role_batcher.queue(payload.guild_id, payload.user_id, role_id, True)
 
     @commands.Cog.listener()
     async def on_raw_reaction_remove(self, payload):
-        guild_id = str(payload.guild_id)
-        try:
-            with open(f"{self.reaction_roles_dir}/{guild_id}.json", "r") as file:
-                reaction_roles = json.load(file)
-        except FileNotFoundError:
+        # Ignore reactions on messages without reaction roles
+        if payload.message_id not in self.indexed_messages:
             return
 
-        message_id = str(payload.message_id)
-        if message_id not in reaction_roles:
+        role_id = self.index.get((payload.guild_id, payload.message_id, str(payload.emoji)))
+        if role_id is None:
             return
 
-        for reaction_role in reaction_roles[message_id]:
-            if str(payload.emoji) == reaction_role["emoji"]:
-                guild = self.bot.get_guild(payload.guild_id)
-                role = guild.get_role(int(reaction_role["role_id"]))
-                if role:
-                    member = guild.get_member(payload.user_id)
-                    if member:
-                        await member.remove_roles(role)
+        # Queue the change, bursts of reactions from the same member are applied together
+        self.role_batcher.queue(payload.guild_id, payload.user_id, role_id, False)
+
+    async def reconcile_guild(self, guild, remove=False):
+        # Reconcile a copy of the guild's reaction roles and keep any message channels that had to be looked up
+        reaction_roles = copy.deepcopy(self.reaction_roles.get(str(guild.id), {}))
+        stats = await self.reconciler.reconcile(guild, reaction_roles, remove)
+        if stats and stats["channels found"] and str(guild.id) in self.reaction_roles:
+            current = copy.deepcopy(self.reaction_roles[str(guild.id)])
+            for message_id, entries in current.items():
+                found = reaction_roles.get(message_id)
+                if found and "channel_id" in found[0]:
+                    for entry in entries:
+                        entry["channel_id"] = found[0]["channel_id"]
+            self.save_reaction_roles(str(guild.id), current)
+        return stats
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # Give roles for reactions that were added while the bot was offline. Roles are never taken away here, members
+        # can have them for other reasons (see /reactionrole sync)
+        if self.reconciled_on_startup:
+            return
+        self.reconciled_on_startup = True
+        for guild_id in list(self.reaction_roles):
+            guild = self.bot.get_guild(int(guild_id))
+            if guild is None or not self.reaction_roles[guild_id]:
+                continue
+            # One guild failing shouldn't stop the others
+            try:
+                stats = await self.reconcile_guild(guild)
+            except discord.HTTPException as e:
+                print(f"Error reconciling reaction roles for {guild.name}:", e)
+                continue
+            if stats:
+                print(f"Reconciled reaction roles for {guild.name}:", stats)
+
+    @cog_ext.cog_subcommand(
+        base="reactionrole",
+        name="sync",
+        description="Update roles to match the reactions on every reaction role message",
+        options=[
+            create_option(
+                name="remove",
+                description="Also take the role from members who haven't reacted, even if they got it another way",
+                option_type=5,
+                required=False
+            )
+        ]
+    )
+    @commands.has_permissions(manage_guild=True)
+    async def sync_reaction_roles(self, ctx: SlashContext, remove: bool = False):
+        await self.rest.defer(ctx, hidden=True)
+        if not self.reaction_roles.get(str(ctx.guild.id)):
+            await self.rest.respond(ctx, "> No reaction roles found for this server.", hidden=True)
+            return
+
+        try:
+            stats = await self.reconcile_guild(ctx.guild, remove)
+        except discord.HTTPException as e:
+            await self.rest.respond(ctx, f"> Could not sync the reaction roles: {e}", hidden=True)
+            return
+        if stats is None:
+            await self.rest.respond(ctx, "> The reaction roles for this server are already being synced.", hidden=True)
+            return
+        stats = "\n".join(f"> {name}: {value}" for name, value in stats.items())
+        await self.rest.respond(ctx, f"Reaction roles synced:\n{stats}", hidden=True)
+
+    @cog_ext.cog_subcommand(
+        base="reactionrole",
+        name="stats",
+        description="Show how reaction role updates are being batched"
+    )
+    @commands.has_permissions(manage_guild=True)
+    async def reaction_role_stats(self, ctx: SlashContext):
+        stats = "\n".join(f"> {name}: {value}" for name, value in self.role_batcher.stats().items())
+        await self.rest.respond(ctx, f"Reaction role statistics:\n{stats}", hidden=True)
 
 
 def setup(bot):
@@ -6,6 +6,7 @@ from discord.ext import commands
 from discord_slash import cog_ext
 from discord_slash.context import SlashContext
 from discord_slash.utils.manage_commands import create_option
+from cmds.RestQueue import get_rest_queue, PRIORITY_MESSAGES
 from datetime import datetime
 
 """
@@ -17,10 +18,12 @@ Author: bradd07
 class RegCommands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        # outbound requests go through the bot-wide queue
+        self.rest = get_rest_queue(bot)
 
     @cog_ext.cog_slash(name="ping", description="Ping the bot to check if it's online")
     async def ping(self, ctx: SlashContext):
-        await ctx.send("Pong!")
+        await self.rest.respond(ctx, "Pong!")
 
     @cog_ext.cog_slash(name="avatar", description="Displays the user's avatar")
     async def avatar(self, ctx: SlashContext, user: discord.User = None):
@@ -31,7 +34,7 @@ class RegCommands(commands.Cog):
         # send the user's avatar URL to the channel
         message = discord.Embed(title=user)
         message.set_image(url=user.avatar_url)
-        await ctx.send(embed=message)
+        await self.rest.respond(ctx, embed=message)
 
     @cog_ext.cog_slash(
         name="purge",
@@ -52,19 +55,20 @@ class RegCommands(commands.Cog):
 
         # check for negative or zero
         if num_messages <= 0:
-            await ctx.send("> Please specify a positive number of messages to delete.", hidden=True)
+            await self.rest.respond(ctx, "> Please specify a positive number of messages to delete.", hidden=True)
             return
 
         # catch any discord errors
         try:
             # bulk delete
-            await ctx.channel.purge(limit=num_messages)
-            await ctx.send(f"Successfully purged {num_messages} messages.", hidden=True)
+            await self.rest.submit(PRIORITY_MESSAGES, f"channel:{ctx.channel.id}", ctx.channel.purge,
+                                   limit=num_messages)
+            await self.rest.respond(ctx, f"Successfully purged {num_messages} messages.", hidden=True)
         except (NotFound, Forbidden, HTTPException):
             # Catch exceptions if the bot cannot delete messages due to permissions or messages being older than 14 days
-            await ctx.send(
-                "> Failed to purge all messages. Make sure the bot has the necessary permissions, the messages are not "
-                "older than 14 days, or try a smaller number at a time.", hidden=True)
+            await self.rest.respond(
+                ctx, "> Failed to purge all messages. Make sure the bot has the necessary permissions, the messages are "
+                "not older than 14 days, or try a smaller number at a time.", hidden=True)
 
     @cog_ext.cog_subcommand(
         base="poll",
@@ -102,7 +106,7 @@ class RegCommands(commands.Cog):
         # check if at least two choices are provided (shouldn't happen)
         num_choices = sum(1 for choice in choices.values() if choice is not None)
         if num_choices < 2:
-            await ctx.send("Please provide at least two choices for the poll.", hidden=True)
+            await self.rest.respond(ctx, "Please provide at least two choices for the poll.", hidden=True)
             return
 
         # get current time
@@ -126,12 +130,18 @@ class RegCommands(commands.Cog):
         embed.set_footer(text=f"Poll created by {ctx.author.display_name} • {current_time.strftime('%m/%d/%Y %I:%M %p')}")
 
         # Send the poll message
-        await ctx.send("> :white_check_mark: Poll created.", hidden=True)
-        poll = await ctx.send(embed=embed)
+        await self.rest.respond(ctx, "> :white_check_mark: Poll created.", hidden=True)
+        poll = await self.rest.respond(ctx, embed=embed)
 
         # Add emoji reactions
         for i in range(num_choices):
-            await poll.add_reaction(emoji_list[i])
+            await self.rest.react(poll, emoji_list[i])
+
+    @cog_ext.cog_slash(name="queuestats", description="Displays statistics about the bot's outbound request queue")
+    @commands.has_permissions(manage_guild=True)
+    async def queue_stats(self, ctx: SlashContext):
+        stats = "\n".join(f"> {name}: {value}" for name, value in self.rest.stats().items())
+        await self.rest.respond(ctx, f"Request queue statistics:\n{stats}", hidden=True)
 
     @cog_ext.cog_slash(name="8ball", description="Ask the magic 8-ball a question")
     async def eight_ball(self, ctx: SlashContext, *, question: str):
@@ -158,7 +168,7 @@ class RegCommands(commands.Cog):
             "Very doubtful"
         ]
         # send a random response
-        await ctx.send(f"> {question}\n:8ball: {random.choice(responses)}")
+        await self.rest.respond(ctx, f"> {question}\n:8ball: {random.choice(responses)}")
 
 
 def setup(bot):
@@ -0,0 +1,166 @@
+import asyncio
+import heapq
+import time
+import discord
+
+"""
+Bot-wide queue for outbound Discord requests (messages, reactions, role edits, ...).
+Requests are run by a few workers in priority order so interaction responses never wait behind bulk work such as
+Twitch announcements, and a couple of extra workers only ever take interaction responses so those can't get stuck
+behind bulk requests that are slow or sleeping on a rate limit. Requests for the same rate-limit bucket run one at a
+time so a busy bucket can't tie up every worker, and producers of low priority work are slowed down once too much is
+queued.
+"""
+
+# priority classes, lower runs first
+PRIORITY_INTERACTION = 0
+PRIORITY_ROLES = 1
+PRIORITY_MESSAGES = 2
+PRIORITY_BULK = 3
+PRIORITY_NAMES = {PRIORITY_INTERACTION: "interaction", PRIORITY_ROLES: "roles", PRIORITY_MESSAGES: "messages",
+                  PRIORITY_BULK: "bulk"}
+
+
+# the queue shared by every cog, created the first time a cog asks for it
+def get_rest_queue(bot):
+    if not hasattr(bot, "rest_queue"):
+        bot.rest_queue = RestQueue()
+    return bot.rest_queue
+
+
+class RestQueue:
+    def __init__(self, workers=8, interaction_workers=2, max_queued=1000):
+        self.workers = workers
+        # extra workers reserved for interaction responses, which have to be answered within 3 seconds
+        self.interaction_workers = interaction_workers
+        self.max_queued = max_queued
+        self.tasks = []
+        # (priority, sequence, bucket, func, args, kwargs, future, time queued)
+        self.heap = []
+        # bucket -> jobs waiting for the request in flight on that bucket
+        self.held = {}
+        self.busy = set()
+        self.queued = 0
+        self.sequence = 0
+        self.changed = asyncio.Condition()
+
+        # metrics
+        self.max_depth = 0
+        self.throttled = 0
+        # priority -> [requests, total wait, max wait]
+        self.waits = {priority: [0, 0.0, 0.0] for priority in PRIORITY_NAMES}
+        # route (the kind of bucket, e.g. "channel") -> [requests, errors, rate limited, total time]
+        self.routes = {}
+
+    def start(self):
+        # start the workers on first use, once the event loop is running
+        if not self.tasks:
+            loop = asyncio.get_event_loop()
+            self.tasks = [loop.create_task(self.work()) for _ in range(self.workers)]
+            self.tasks += [loop.create_task(self.work(interactions_only=True)) for _ in range(self.interaction_workers)]
+
+    async def submit(self, priority, bucket, func, *args, **kwargs):
+        # queues func(*args, **kwargs) and returns its result once a worker has run it
+        self.start()
+        async with self.changed:
+            # backpressure, everything but interaction responses waits for room in the queue
+            if priority > PRIORITY_INTERACTION and self.queued >= self.max_queued:
+                self.throttled += 1
+                while self.queued >= self.max_queued:
+                    await self.changed.wait()
+
+            future = asyncio.get_event_loop().create_future()
+            self.sequence += 1
+            heapq.heappush(self.heap, (priority, self.sequence, bucket, func, args, kwargs, future, time.monotonic()))
+            self.queued += 1
+            self.max_depth = max(self.max_depth, self.queued)
+            self.changed.notify_all()
+        return await future
+
+    async def take(self, interactions_only=False):
+        # the highest priority job whose bucket is free
+        async with self.changed:
+            while True:
+                while self.heap:
+                    # interactions always come first, so if the top job isn't one there are none waiting
+                    if interactions_only and self.heap[0][0] != PRIORITY_INTERACTION:
+                        break
+                    job = heapq.heappop(self.heap)
+                    if job[2] in self.busy:
+                        self.held.setdefault(job[2], []).append(job)
+                        continue
+                    self.busy.add(job[2])
+                    self.queued -= 1
+                    self.changed.notify_all()
+                    return job
+                await self.changed.wait()
+
+    async def release(self, bucket):
+        # let the jobs held back for this bucket run again, in their original order
+        async with self.changed:
+            self.busy.discard(bucket)
+            for job in self.held.pop(bucket, []):
+                heapq.heappush(self.heap, job)
+            self.changed.notify_all()
+
+    async def work(self, interactions_only=False):
+        while True:
+            priority, _, bucket, func, args, kwargs, future, queued_at = await self.take(interactions_only)
+            started = time.monotonic()
+            wait = self.waits[priority]
+            wait[0] += 1
+            wait[1] += started - queued_at
+            wait[2] = max(wait[2], started - queued_at)
+            route = self.routes.setdefault(bucket.split(":", 1)[0], [0, 0, 0, 0.0])
+            route[0] += 1
+
+            try:
+                # skip the request if whoever queued it has given up on it
+                if not future.done():
+                    result = await func(*args, **kwargs)
+                    if not future.done():
+                        future.set_result(result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                route[1] += 1
+                if isinstance(e, discord.HTTPException) and e.status == 429:
+                    route[2] += 1
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                route[3] += time.monotonic() - started
+                await self.release(bucket)
+
+    # shortcuts for the requests the cogs make
+
+    async def respond(self, ctx, *args, **kwargs):
+        return await self.submit(PRIORITY_INTERACTION, f"interaction:{ctx.interaction_id}", ctx.send, *args, **kwargs)
+
+    async def defer(self, ctx, hidden=False):
+        return await self.submit(PRIORITY_INTERACTION, f"interaction:{ctx.interaction_id}", ctx.defer, hidden=hidden)
+
+    async def send(self, channel, *args, priority=PRIORITY_MESSAGES, **kwargs):
+        return await self.submit(priority, f"channel:{channel.id}", channel.send, *args, **kwargs)
+
+    async def react(self, message, emoji, priority=PRIORITY_MESSAGES):
+        return await self.submit(priority, f"reactions:{message.channel.id}", message.add_reaction, emoji)
+
+    async def clear_reactions(self, message, emoji=None, priority=PRIORITY_MESSAGES):
+        # clears one emoji, or every reaction if no emoji is given
+        if emoji is None:
+            return await self.submit(priority, f"reactions:{message.channel.id}", message.clear_reactions)
+        return await self.submit(priority, f"reactions:{message.channel.id}", message.clear_reaction, emoji)
+
+    def stats(self):
+        stats = {"queue depth": self.queued, "max queue depth": self.max_depth, "producers throttled": self.throttled,
+                 "busy buckets": len(self.busy)}
+        for priority, (count, total, longest) in self.waits.items():
+            if count:
+                name = PRIORITY_NAMES[priority]
+                stats[f"{name} average wait (ms)"] = round(total / count * 1000, 1)
+                stats[f"{name} max wait (ms)"] = round(longest * 1000, 1)
+        for route, (count, errors, rate_limited, total) in sorted(self.routes.items()):
+            stats[f"{route} requests"] = f"{count} ({errors} failed, {rate_limited} rate limited, " \
+                                         f"{round(total / count * 1000, 1)} ms average)"
+        return stats
@@ -0,0 +1,83 @@
+import asyncio
+import time
+import discord
+from cmds.RestQueue import get_rest_queue, PRIORITY_ROLES
+
+"""
+Gathers role changes for a member over a short window and applies only the net result.
+Adding and then removing the same role within the window collapses into one change. Changes are sent through the per
+role endpoints rather than by replacing the member's whole role list, so a batch never undoes an earlier batch that is
+still waiting in the queue, or a change someone else made at the same time.
+"""
+
+
+class RoleBatcher:
+    def __init__(self, bot, window=1.0):
+        self.bot = bot
+        self.window = window
+        self.rest = get_rest_queue(bot)
+        # (guild id, member id) -> [{role id: True to add / False to remove}, time of the first change, events]
+        self.pending = {}
+        self.changes = 0
+        self.applied = 0
+        self.batches = 0
+        self.calls = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+
+    def queue(self, guild_id, member_id, role_id, add):
+        self.changes += 1
+        key = (guild_id, member_id)
+        if key in self.pending:
+            # the latest change to a role wins
+            self.pending[key][0][role_id] = add
+            self.pending[key][2] += 1
+            return
+
+        # first change for this member, apply everything once the window is over
+        self.pending[key] = [{role_id: add}, time.monotonic(), 1]
+        asyncio.get_event_loop().create_task(self.apply_later(key))
+
+    async def apply_later(self, key):
+        await asyncio.sleep(self.window)
+        changes, queued_at, events = self.pending.pop(key)
+
+        # track how long changes waited
+        self.batches += 1
+        self.applied += events
+        delay = time.monotonic() - queued_at
+        self.total_delay += delay
+        self.max_delay = max(self.max_delay, delay)
+
+        try:
+            await self.apply(key[0], key[1], changes)
+        except (discord.Forbidden, discord.HTTPException) as e:
+            print(f"Error updating roles for member {key[1]}:", e)
+
+    async def apply(self, guild_id, member_id, changes, priority=PRIORITY_ROLES):
+        guild = self.bot.get_guild(guild_id)
+        member = guild.get_member(member_id) if guild else None
+        if member is None:
+            return
+
+        # the member cache can be behind on changes that are still queued, so every net change is sent as is
+        roles = {role_id: guild.get_role(role_id) for role_id in changes}
+        adds = [role for role_id, role in roles.items() if role is not None and changes[role_id]]
+        removes = [role for role_id, role in roles.items() if role is not None and not changes[role_id]]
+
+        # one call per role, in the order they were queued. the bucket is per member so different members are updated
+        # in parallel, discord.py takes care of the actual rate limits
+        bucket = f"members:{guild_id}:{member_id}"
+        if adds:
+            self.calls += len(adds)
+            await self.rest.submit(priority, bucket, member.add_roles, *adds)
+        if removes:
+            self.calls += len(removes)
+            await self.rest.submit(priority, bucket, member.remove_roles, *removes)
+
+    def stats(self):
+        # every change used to be its own call, now changes to the same role within a batch share one
+        average_delay = self.total_delay / self.batches if self.batches else 0
+        return {"role changes": self.changes, "role calls": self.calls, "calls saved": self.applied - self.calls,
+                "average queue delay (ms)": round(average_delay * 1000, 1),
+                "max queue delay (ms)": round(self.max_delay * 1000, 1)}
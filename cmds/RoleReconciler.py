@@ -0,0 +1,126 @@
+import asyncio
+import time
+import discord
+from cmds.RestQueue import PRIORITY_BULK
+
+"""
+Brings reaction roles back in line with the reactions on their messages, for changes made while the bot was offline.
+Reactors are paged from the API once per configured reaction, diffed against each role's current members and the
+corrections are applied role by role (see RoleBatcher), a few members at a time.
+"""
+
+
+class RoleReconciler:
+    def __init__(self, bot, role_batcher, max_concurrency=5, max_retries=3):
+        self.bot = bot
+        self.role_batcher = role_batcher
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_retries = max_retries
+        # guilds with a reconciliation in progress
+        self.running = set()
+
+    async def find_message(self, guild, message_id, channel_id=None):
+        # returns the message, looking through every text channel if we don't know where it was posted
+        channels = [guild.get_channel(int(channel_id))] if channel_id else guild.text_channels
+        for channel in channels:
+            if channel is None:
+                continue
+            try:
+                return await channel.fetch_message(int(message_id))
+            except (discord.NotFound, discord.Forbidden):
+                continue
+        return None
+
+    async def reactors(self, message, emojis):
+        # emoji -> ids of the members who reacted with it, fetched 100 at a time by discord.py
+        reactors = {}
+        for reaction in message.reactions:
+            emoji = str(reaction.emoji)
+            if emoji not in emojis:
+                continue
+            reactors[emoji] = {user.id async for user in reaction.users(limit=None) if not user.bot}
+        return reactors
+
+    async def apply(self, guild_id, member_id, changes):
+        # returns True if the member was updated or already had the right roles
+        async with self.semaphore:
+            for attempt in range(self.max_retries):
+                try:
+                    await self.role_batcher.apply(guild_id, member_id, changes, PRIORITY_BULK)
+                    return True
+                except discord.HTTPException as e:
+                    # discord.py retries rate limits itself, back off if one still gets through
+                    if e.status != 429 or attempt == self.max_retries - 1:
+                        print(f"Error reconciling roles for member {member_id}:", e)
+                        return False
+                    await asyncio.sleep(float(e.response.headers.get("Retry-After", 1)))
+            return False
+
+    async def reconcile(self, guild, reaction_roles, remove=False):
+        # reaction_roles uses the same layout as the cog, {message_id: [{"emoji": ..., "role_id": ...}]}. the channel
+        # of messages that had to be searched for is stored in their entries as "channel_id". roles are only taken
+        # from members who haven't reacted if remove is set, they may have gotten the role some other way
+        # returns None if the guild is already being reconciled
+        if guild.id in self.running:
+            return None
+        self.running.add(guild.id)
+        try:
+            return await self.run(guild, reaction_roles, remove)
+        finally:
+            self.running.discard(guild.id)
+
+    async def run(self, guild, reaction_roles, remove):
+        started = time.perf_counter()
+        stats = {"messages checked": 0, "messages missing": 0, "channels found": 0, "reactors": 0,
+                 "roles added": 0, "roles removed": 0, "failed members": 0}
+
+        # role id -> ids of members who reacted for it. a role can be given by more than one reaction, members keep it
+        # as long as they have any of them
+        reacted = {}
+        # roles that are also given by a message we couldn't find, nobody loses these
+        keep = set()
+        for message_id, entries in reaction_roles.items():
+            channel_id = next((entry["channel_id"] for entry in entries if "channel_id" in entry), None)
+            message = await self.find_message(guild, message_id, channel_id)
+            if message is None:
+                # leave the roles alone rather than taking them from everyone
+                stats["messages missing"] += 1
+                keep.update(int(entry["role_id"]) for entry in entries)
+                continue
+            stats["messages checked"] += 1
+
+            # remember where the message is so the next run doesn't have to search for it
+            if channel_id is None:
+                stats["channels found"] += 1
+                for entry in entries:
+                    entry["channel_id"] = str(message.channel.id)
+
+            reactors = await self.reactors(message, {entry["emoji"] for entry in entries})
+            for entry in entries:
+                user_ids = reactors.get(entry["emoji"], set())
+                stats["reactors"] += len(user_ids)
+                reacted.setdefault(int(entry["role_id"]), set()).update(user_ids)
+
+        # diff against the current role members, member id -> {role id: True to add / False to remove}
+        changes = {}
+        for role_id, user_ids in reacted.items():
+            role = guild.get_role(role_id)
+            if role is None:
+                continue
+            members = {member.id for member in role.members if not member.bot}
+            for member_id in user_ids - members:
+                # skip users who have left the guild
+                if guild.get_member(member_id):
+                    changes.setdefault(member_id, {})[role_id] = True
+                    stats["roles added"] += 1
+            if not remove or role_id in keep:
+                continue
+            for member_id in members - user_ids:
+                changes.setdefault(member_id, {})[role_id] = False
+                stats["roles removed"] += 1
+
+        results = await asyncio.gather(*(self.apply(guild.id, member_id, member_changes)
+                                         for member_id, member_changes in changes.items()))
+        stats["failed members"] = results.count(False)
+        stats["seconds"] = round(time.perf_counter() - started, 1)
+        return stats
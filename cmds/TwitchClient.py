@@ -0,0 +1,143 @@
+import asyncio
+import json
+import aiohttp
+from cmds.TwitchCredentials import TwitchCredentials
+
+"""
+Non-blocking client for the Twitch API.
+Every request goes through one aiohttp session, so connections to Twitch are pooled and kept alive between polls
+instead of being opened again for every broadcaster, and no request can hold up the bot for longer than the timeout.
+"""
+
+TOKEN_URL = "https://id.twitch.tv/oauth2/token"
+VALIDATE_URL = "https://id.twitch.tv/oauth2/validate"
+STREAMS_URL = "https://api.twitch.tv/helix/streams"
+USERS_URL = "https://api.twitch.tv/helix/users"
+SUBSCRIPTIONS_URL = "https://api.twitch.tv/helix/eventsub/subscriptions"
+
+
+class TwitchClient:
+    def __init__(self, client_id, client_secret, access_token=None, timeout=10, max_connections=10, keepalive=60):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        # the app access token, refreshed before it expires
+        self.credentials = TwitchCredentials(self, access_token)
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.keepalive = keepalive
+        self.session = None
+        self.requests = 0
+        self.failures = 0
+
+    def get_session(self):
+        # created on first use so it belongs to the running event loop
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=self.keepalive,
+                                             ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def request(self, method, url, **kwargs):
+        # returns (status, json body), or (None, {}) if Twitch could not be reached
+        self.requests += 1
+        try:
+            async with self.get_session().request(method, url, **kwargs) as response:
+                # some responses (such as deleting a subscription) have no body
+                text = await response.text()
+                return response.status, json.loads(text) if text else {}
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            self.failures += 1
+            print("Error:", e or type(e).__name__)
+            return None, {}
+
+    async def get_oauth_token(self):
+        # generates a new app access token, returns (token, seconds until it expires) or None if it could not be
+        # generated
+        payload = {
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'grant_type': 'client_credentials'
+        }
+        status, data = await self.request("POST", TOKEN_URL, params=payload)
+        if 'access_token' in data:
+            return data['access_token'], data.get('expires_in', 0)
+        if status is not None:
+            print("Error:", data.get('message', 'Failed to get access token'))
+        return None
+
+    async def validate_token(self, token):
+        # returns (status, seconds until the token expires). status is 401 if the token isn't valid and None if
+        # Twitch could not be reached
+        status, data = await self.request("GET", VALIDATE_URL, headers={"Authorization": f"OAuth {token}"})
+        return status, data.get("expires_in", 0) if status == 200 else None
+
+    async def helix(self, method, url, **kwargs):
+        # a request to the helix API with the current token, sent again once with a new token if it was rejected
+        token = await self.credentials.get_token()
+        status, data = await self.request(method, url, headers=self.headers(token), **kwargs)
+        if status == 401:
+            token = await self.credentials.refresh(token)
+            status, data = await self.request(method, url, headers=self.headers(token), **kwargs)
+        return status, data
+
+    def headers(self, token):
+        return {
+            "Client-ID": self.client_id,
+            "Authorization": f"Bearer {token}"
+        }
+
+    async def get_streams(self, logins):
+        # returns the live streams of the given broadcasters, an empty list if none are live or None if the request
+        # failed
+        params = [("user_login", login) for login in logins] + [("first", "100")]
+        status, data = await self.helix("GET", STREAMS_URL, params=params)
+        if status != 200:
+            return None
+        return data.get("data") or []
+
+    async def get_user_ids(self, logins):
+        # login -> user id for up to 100 broadcasters, returns None if the request failed
+        params = [("login", login) for login in logins]
+        status, data = await self.helix("GET", USERS_URL, params=params)
+        if status != 200:
+            return None
+        return {user["login"].lower(): user["id"] for user in data.get("data", [])}
+
+    async def get_subscriptions(self):
+        # every eventsub subscription of this app, returns None if they could not all be fetched
+        subscriptions = []
+        params = {}
+        while True:
+            status, data = await self.helix("GET", SUBSCRIPTIONS_URL, params=params)
+            if status != 200:
+                return None
+            subscriptions.extend(data.get("data", []))
+            cursor = data.get("pagination", {}).get("cursor")
+            if not cursor:
+                return subscriptions
+            params = {"after": cursor}
+
+    async def create_subscription(self, event_type, user_id, callback, secret):
+        body = {
+            "type": event_type,
+            "version": "1",
+            "condition": {"broadcaster_user_id": user_id},
+            "transport": {"method": "webhook", "callback": callback, "secret": secret}
+        }
+        status, data = await self.helix("POST", SUBSCRIPTIONS_URL, json=body)
+        if status != 202:
+            print("Error:", data.get("message", f"Failed to subscribe to {event_type} for {user_id}"))
+        return status == 202
+
+    async def delete_subscription(self, subscription_id):
+        status, _ = await self.helix("DELETE", SUBSCRIPTIONS_URL, params={"id": subscription_id})
+        return status == 204
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    def stats(self):
+        return {"twitch requests": self.requests, "failed twitch requests": self.failures,
+                **self.credentials.stats()}
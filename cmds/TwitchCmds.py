@@ -1,84 +1,140 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 import discord
-import requests
 import asyncio
-import json
 from discord.ext import commands
 from discord_slash import cog_ext
 from discord_slash.context import SlashContext
 from discord_slash.utils.manage_commands import create_option
 from dotenv import load_dotenv
+from cmds.AnnouncementLog import AnnouncementLog
+from cmds.EventSub import EventSubReceiver, EVENT_TYPES
+from cmds.LoopMonitor import LoopMonitor
+from cmds.PollSchedule import PollSchedule
+from cmds.RestQueue import get_rest_queue, PRIORITY_BULK
+from cmds.TwitchClient import TwitchClient
+from cmds.TwitchSettings import TwitchSettings, is_login
 import os
 import pytz
+import time
 
 """
 Cog for twitch announcement commands.
 Author: bradd07
 """
 
+# most broadcasters twitch returns from one /helix/streams request
+STREAMS_PER_REQUEST = 100
 
-# generates a new twitch OAUTH token when requested
-def get_oauth_token():
-    # twitch API endpoint for OAuth token generation
-    url = 'https://id.twitch.tv/oauth2/token'
+# seconds between checking which broadcasters are due, each one has its own interval (see PollSchedule)
+POLL_TICK = 10
 
-    # twitch IDs
-    client_id = os.getenv("TWITCH_CLIENT_ID")
-    client_secret = os.getenv("TWITCH_SECRET")
+# most /helix/streams requests sent per minute
+POLL_BUDGET_PER_MINUTE = 60
 
-    # generate payload
-    payload = {
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'grant_type': 'client_credentials'
-    }
+# seconds between checking the settings files for changes made outside the bot
+SETTINGS_CHECK_INTERVAL = 60
 
-    try:
-        # making a POST request to the Twitch API
-        response = requests.post(url, params=payload)
-        data = response.json()
+# seconds between logging how polling went, eventsub subscriptions are also checked then
+SUMMARY_INTERVAL = 600
 
-        # check if access token is present in response
-        if 'access_token' in data:
-            # yay
-            return data['access_token']
-        else:
-            # nay
-            print("Error:", data.get('message', 'Failed to get access token'))
-            return None
-
-    # catch errors
-    except requests.RequestException as e:
-        print("Error:", e)
-        return None
-
-
-# automatically updates the locally stored .env file with new values
-def update_env_file(key, value):
-    # load existing .env file
-    dotenv_path = '.env'
-    with open(dotenv_path, 'r') as file:
-        lines = file.readlines()
-
-    # write the new value
-    with open(dotenv_path, 'w') as file:
-        for line in lines:
-            if line.startswith(key):
-                file.write(f"{key}={value}\n")
-            else:
-                file.write(line)
+# seconds to wait before reconciling eventsub subscriptions again after a failure, doubled for every failure in a row
+RECONCILE_RETRY_DELAY = 30
+
+# most announcements of a stream being sent at the same time
+ANNOUNCE_CONCURRENCY = 10
+
+# announcements show the time in MST
+MST_TIMEZONE = pytz.timezone('America/Phoenix')
+
+# images used in the announcements
+FLAZH_IMAGE_URL = 'https://media.discordapp.net/attachments/1049713626895896686/1245587352693379154/livenow.png?ex=' \
+                  '66cdf7de&is=66cca65e&hm=3b0c29d57726e493805c28cacd4e81c400e549650bf3ced522068d2a0cabdc66&=&format=' \
+                  'webp&quality=lossless&width=550&height=309'
+THUMBNAIL_URL = 'https://media.discordapp.net/attachments/1049713626895896686/1245587273538605117/newlogo.png?ex=66cdf7' \
+                'cb&is=66cca64b&hm=3a39e66fa6fbdce183d99f9f5616ff24a2d357421bb52911b286ad2e6e586ac1&=&format=webp&qual' \
+                'ity=lossless&width=920&height=460'
+TWITCH_ICON_URL = "https://cdn-longterm.mee6.xyz/plugins/twitch/logo.png"
+
+# attempts and seconds between them to get the stream data of a broadcaster that eventsub says went live
+ONLINE_LOOKUP_ATTEMPTS = 3
+ONLINE_LOOKUP_DELAY = 5
+
+
+# builds the go-live message and embed for a stream
+def build_announcement(stream_data):
+    stream_title = stream_data["title"]
+    stream_url = f"https://www.twitch.tv/{stream_data['user_login']}"
+    viewer_count = stream_data["viewer_count"]
+    game_name = stream_data["game_name"]
+
+    # set up embed
+    embed = discord.Embed(
+        title=f"**{stream_title}**",
+        url=stream_url,
+        color=discord.Color.red()
+    )
+    embed.set_author(name=stream_data['user_name'])
+    if stream_data['user_name'] == 'xFlxZh':
+        # set custom thumbnail for flazh...
+        embed.set_image(url=FLAZH_IMAGE_URL)
+    else:
+        # default to Twitch stream thumbnail
+        embed.set_image(url=stream_data['thumbnail_url'].replace("{width}", "320").replace("{height}", "180"))
+    embed.set_thumbnail(url=THUMBNAIL_URL)
+    embed.add_field(name="Viewers", value=viewer_count, inline=False)
+    embed.add_field(name="Game", value=game_name, inline=False)
+
+    # get mst current time
+    mst_now = datetime.now(tz=MST_TIMEZONE)
+    embed.set_footer(text="Twitch • " + mst_now.strftime("%m/%d/%Y %I:%M %p"), icon_url=TWITCH_ICON_URL)
+
+    content = f"Hey @everyone, {stream_data['user_name']} is now live on Twitch! Come and support the stream! Leave a " \
+              f"comment and chat with them!"
+    return content, embed
 
 
 class TwitchCmds(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        # outbound requests go through the bot-wide queue
+        self.rest = get_rest_queue(bot)
         # define twitch client id and access token from environment variables
         load_dotenv()
         self.twitch_client_id = os.getenv("TWITCH_CLIENT_ID")
-        self.twitch_access_token = os.getenv("TWITCH_ACCESS_TOKEN")
-        self.streams = {}
-        self.settings = {}
-        self.load_settings()  # load settings from json file
+        # pooled, non-blocking connection to the twitch API, it also keeps the access token valid
+        self.twitch = TwitchClient(self.twitch_client_id, os.getenv("TWITCH_SECRET"), os.getenv("TWITCH_ACCESS_TOKEN"))
+        # measures how long the event loop gets blocked during a check
+        self.loop_monitor = LoopMonitor()
+        self.check_task = None
+        # when each broadcaster is polled next
+        self.schedule = PollSchedule(budget_per_minute=POLL_BUDGET_PER_MINUTE, batch_size=STREAMS_PER_REQUEST)
+        # push notifications from eventsub, if a callback is configured. polling is then only a fallback
+        self.eventsub_callback = os.getenv("TWITCH_EVENTSUB_CALLBACK")
+        self.eventsub_secret = os.getenv("TWITCH_EVENTSUB_SECRET")
+        self.eventsub = None
+        if self.eventsub_callback and self.eventsub_secret:
+            self.eventsub = EventSubReceiver(self.eventsub_secret, self.on_eventsub,
+                                             port=int(os.getenv("TWITCH_EVENTSUB_PORT") or 8080))
+        # broadcasters the subscriptions were last reconciled for, None to reconcile on the next check
+        self.subscribed_logins = None
+        # user id -> login of the broadcasters with subscriptions
+        self.user_logins = {}
+        # failed reconciles in a row, and when to try again
+        self.reconcile_failures = 0
+        self.reconcile_retry_at = 0
+        # streams that were announced, kept across restarts
+        self.announcements = AnnouncementLog()
+        self.announcements_lock = asyncio.Lock()
+        # announcements are sent to a few channels at a time
+        self.delivery_semaphore = asyncio.Semaphore(ANNOUNCE_CONCURRENCY)
+        self.deliveries = 0
+        self.delivery_failures = 0
+        self.delivery_time = 0.0
+        self.max_delivery_time = 0.0
+        # guild settings, kept in memory with an index of which guilds follow each broadcaster
+        self.settings = TwitchSettings()
+        # index version the schedule was last synced with
+        self.synced_version = None
 
     @cog_ext.cog_subcommand(
         base="twitch",
@@ -98,23 +154,24 @@ class TwitchCmds(commands.Cog):
         # get guild
         guild_id = str(ctx.guild.id)
 
-        # check if we have a list for this guild yet
-        if guild_id not in self.settings:
-            self.settings[guild_id] = {}
+        # get this guild's settings
+        data = self.settings.guild(guild_id)
 
         # set to lower to caps doesn't matter
         name = name.lower()
 
+        # make sure this is a name twitch accepts
+        if not is_login(name):
+            await self.rest.respond(ctx, "> That is not a valid Twitch username.", hidden=True)
         # check if this streamer is already in the list
-        if "names" in self.settings[guild_id] and name in self.settings[guild_id]["names"]:
-            await ctx.send(f"> {name} is already in the list of broadcasters.")
+        elif "names" in data and name in data["names"]:
+            await self.rest.respond(ctx, f"> {name} is already in the list of broadcasters.")
         # else assume this streamer is not in the list yet
         else:
-            self.settings[guild_id].setdefault("names", []).append(name)
-            await ctx.send(f"> Added {name} to the list of broadcasters to check.")
-
-        # save settings
-        self.save_settings()
+            data.setdefault("names", []).append(name)
+            # save settings
+            self.settings.save(guild_id)
+            await self.rest.respond(ctx, f"> Added {name} to the list of broadcasters to check.")
 
     @cog_ext.cog_subcommand(
         base="twitch",
@@ -134,23 +191,21 @@ class TwitchCmds(commands.Cog):
         # get guild
         guild_id = str(ctx.guild.id)
 
-        # check if we have a list for this guild yet
-        if guild_id not in self.settings:
-            self.settings[guild_id] = {}
+        # get this guild's settings
+        data = self.settings.guild(guild_id)
 
         # set to lower to caps doesn't matter
         name = name.lower()
 
         # check if this streamer is already in the list
-        if "names" in self.settings[guild_id] and name in self.settings[guild_id]["names"]:
-            self.settings[guild_id]["names"].remove(name)
-            await ctx.send(f"> Removed {name} from the list of broadcasters.")
+        if "names" in data and name in data["names"]:
+            data["names"].remove(name)
+            # save settings
+            self.settings.save(guild_id)
+            await self.rest.respond(ctx, f"> Removed {name} from the list of broadcasters.")
         # else assume this streamer is not in the list yet
         else:
-            await ctx.send(f"> {name} is not in the list of broadcasters.")
-
-        # save settings
-        self.save_settings()
+            await self.rest.respond(ctx, f"> {name} is not in the list of broadcasters.")
 
     @cog_ext.cog_subcommand(
         base="twitch",
@@ -165,6 +220,16 @@ class TwitchCmds(commands.Cog):
         # list broadcasters
         await self.list_broadcasters(ctx, guild_id)
 
+    @cog_ext.cog_subcommand(
+        base="twitch",
+        name="stats",
+        description="Show statistics about stream checks and announcements",
+    )
+    @commands.has_permissions(manage_guild=True)
+    async def twitch_stats(self, ctx: SlashContext):
+        stats = "\n".join(f"> {name}: {value}" for name, value in self.stats().items())
+        await self.rest.respond(ctx, f"Twitch statistics:\n{stats}", hidden=True)
+
     @cog_ext.cog_subcommand(
         base="twitch",
         name="setchannel",
@@ -183,16 +248,12 @@ class TwitchCmds(commands.Cog):
         # get guild
         guild_id = str(ctx.guild.id)
 
-        # check if we have a list for this guild yet
-        if guild_id not in self.settings:
-            self.settings[guild_id] = {}
-
         # set channel id for this guild
-        self.settings[guild_id]["channel_id"] = channel_id.id
+        self.settings.guild(guild_id)["channel_id"] = channel_id.id
 
-        # notify and save
-        await ctx.send(f"> Set announcement channel to <#{channel_id.id}>.")
-        self.save_settings()
+        # save and notify
+        self.settings.save(guild_id)
+        await self.rest.respond(ctx, f"> Set announcement channel to <#{channel_id.id}>.")
 
     @cog_ext.cog_subcommand(
         base="twitch",
@@ -212,255 +273,298 @@ class TwitchCmds(commands.Cog):
         # get guild
         guild_id = str(ctx.guild.id)
 
-        # check if we have a list for this guild yet
-        if guild_id not in self.settings:
-            self.settings[guild_id] = {}
+        # get this guild's settings
+        data = self.settings.guilds.get(guild_id, {})
 
         # set to lower to caps doesn't matter
         name = name.lower()
 
         # check if this streamer is in the list
-        if "names" in self.settings[guild_id] and name in self.settings[guild_id]["names"]:
+        if "names" in data and name in data["names"]:
             # force announcement
-            await ctx.send("> Attempting to force the announcement...", delete_after=5)
+            await self.rest.respond(ctx, "> Attempting to force the announcement...", delete_after=5)
             await self.force_announcement(ctx, guild_id, name)
         # else assume this streamer is not in the list yet
         else:
-            await ctx.send(f"{name} is not in the list of broadcasters.")
-
-        # save settings
-        self.save_settings()
-
-    def load_settings(self):
-        # try to open settings file
-        try:
-            with open("./settings.json", "r") as f:
-                # load settings
-                self.settings = json.load(f)
-        except FileNotFoundError:
-            # assume no file exists, set default
-            self.settings = {}
-
-    def save_settings(self):
-        # open settings file to write
-        with open("./settings.json", "w") as f:
-            json.dump(self.settings, f)
-
-    async def validate_token(self):
-        # set up get request
-        url = "https://id.twitch.tv/oauth2/validate"
-        headers = {
-            "Authorization": f"OAuth {self.twitch_access_token}"
-        }
-
-        # send request
-        response = requests.get(url, headers=headers)
-
-        # check response
-        if response.status_code == 200:
-            print("Token is valid")
-        else:
-            print("Token is invalid... Generating a new one")
-            token = get_oauth_token()
-            if token:
-                # update token
-                print(f"Generated OAuth Access Token: {token}")
-                os.environ['TWITCH_ACCESS_TOKEN'] = token
-                update_env_file('TWITCH_ACCESS_TOKEN', token)
+            await self.rest.respond(ctx, f"{name} is not in the list of broadcasters.")
+
+    def cog_unload(self):
+        # stop checking streams and close the connections to twitch
+        if self.check_task:
+            self.check_task.cancel()
+        self.loop_monitor.stop()
+        self.twitch.credentials.stop()
+        self.schedule.save()
+        entries = self.announcements.snapshot(time.time())
+        if entries is not None:
+            self.announcements.save(entries)
+        if self.bot.loop.is_running():
+            self.bot.loop.create_task(self.twitch.close())
+            if self.eventsub:
+                self.bot.loop.create_task(self.eventsub.stop())
+
+    def start_checking(self):
+        # start the stream checks once, on_ready can happen again after a reconnect
+        if self.check_task is None:
+            self.check_task = self.bot.loop.create_task(self.check_streams())
 
     async def check_streams(self):
         # wait until the bot is ready to start checking streams
         await self.bot.wait_until_ready()
+        self.loop_monitor.start()
+        self.twitch.credentials.start()
+        if self.eventsub:
+            # polling covers everything if we can't listen for eventsub messages
+            try:
+                await self.eventsub.start()
+            except OSError as e:
+                print("Error starting the Twitch EventSub receiver, polling every broadcaster instead:", e)
+                self.eventsub = None
+        last_summary = last_settings_check = 0
+        polled = requests_sent = 0
         while not self.bot.is_closed():
-            # load guild settings
-            self.load_settings()
-
-            # validate our token
-            await self.validate_token()
-
-            # get live stream data for every streamer in every guild
-            for guild_id, data in self.settings.items():
-                await self.get_live_streams(guild_id, data)
-
-            # check every 10 mins... this is so that the stream has time to generate a thumbnail
-            await asyncio.sleep(600)
-
-    async def get_live_streams(self, guild_id, dataz):
-        # get each broadcaster for this guild
-        for username in dataz.get("names", []):
-            # set up get request
-            url = "https://api.twitch.tv/helix/streams"
-            params = {
-                "user_login": username
-            }
-            headers = {
-                "Client-ID": self.twitch_client_id,
-                "Authorization": f"Bearer {self.twitch_access_token}"
-            }
-
-            # send request
-            response = requests.get(url, params=params, headers=headers)
-            data = response.json()
-
-            # check for data
-            if 'data' in data:
-                if data["data"]:
-                    stream_id = data["data"][0]["id"]
-                    # check if we haven't announced this stream by ID
-                    if stream_id not in self.streams.get(guild_id, {}):
-                        self.streams.setdefault(guild_id, {})[stream_id] = datetime.now()
-                        # try to send message
-                        await self.send_live_stream_message(guild_id, data["data"][0])
+            now = time.time()
+
+            # report on the last few minutes of polling
+            if now - last_summary >= SUMMARY_INTERVAL:
+                if last_summary:
+                    print(f"Polled {polled} Twitch streams with {requests_sent} requests in the last "
+                          f"{now - last_summary:.0f}s, longest event loop stall {self.loop_monitor.reset() * 1000:.1f} "
+                          f"ms, {self.schedule.stats()}")
+                    self.schedule.save()
+                    await self.save_announcements()
+                self.subscribed_logins = None
+                last_summary = now
+                polled = requests_sent = 0
+
+            # pick up settings files changed outside the bot, only the changed ones are read again
+            if now - last_settings_check >= SETTINGS_CHECK_INTERVAL:
+                self.settings.refresh()
+                last_settings_check = now
+
+            # every broadcaster that is due is looked up once, no matter how many guilds follow them. the schedule
+            # and subscriptions only need another look when the followed broadcasters changed
+            subscribers = self.settings.subscribers
+            changed = self.settings.version != self.synced_version
+            if changed:
+                self.schedule.sync(subscribers, now)
+                self.synced_version = self.settings.version
+            if self.eventsub and (changed or self.subscribed_logins is None) and now >= self.reconcile_retry_at \
+                    and set(subscribers) != self.subscribed_logins:
+                if await self.reconcile_subscriptions(set(subscribers)):
+                    self.reconcile_failures = 0
+                else:
+                    # back off instead of trying again every tick
+                    self.reconcile_failures += 1
+                    self.reconcile_retry_at = now + min(SUMMARY_INTERVAL,
+                                                        RECONCILE_RETRY_DELAY * 2 ** (self.reconcile_failures - 1))
+            due = self.schedule.take_due(now)
+            if due:
+                live_streams, sent, failed = await self.get_live_streams(due)
+                # a failed request doesn't mean everyone in it went offline
+                self.schedule.update([login for login in due if login not in failed], live_streams, time.time())
+                self.schedule.retry(failed, time.time())
+                polled += len(due) - len(failed)
+                requests_sent += sent
+
+                # hand the streams to every guild that follows the broadcaster, without holding up the polling
+                for login, stream_data in live_streams.items():
+                    self.bot.loop.create_task(self.announce_stream(stream_data, dict(subscribers.get(login, {}))))
+
+            await asyncio.sleep(POLL_TICK)
+
+    async def get_live_streams(self, logins):
+        # returns (login -> stream data for the broadcasters that are live, number of requests sent, logins whose
+        # request failed)
+        logins = list(logins)
+        live_streams = {}
+        requests_sent = 0
+        failed = set()
+        # twitch accepts up to 100 logins per request
+        for i in range(0, len(logins), STREAMS_PER_REQUEST):
+            batch = logins[i:i + STREAMS_PER_REQUEST]
+            streams = await self.twitch.get_streams(batch)
+            requests_sent += 1
+            if streams is None:
+                failed.update(batch)
+                continue
+            for stream_data in streams:
+                live_streams[stream_data["user_login"].lower()] = stream_data
+        return live_streams, requests_sent, failed
+
+    async def reconcile_subscriptions(self, logins):
+        # makes the eventsub subscriptions match the followed broadcasters, creating missing or failed ones and
+        # deleting the ones nobody follows anymore. returns False if twitch couldn't be asked
+        logins = sorted(logins)
+        user_ids = {}
+        for i in range(0, len(logins), STREAMS_PER_REQUEST):
+            found = await self.twitch.get_user_ids(logins[i:i + STREAMS_PER_REQUEST])
+            if found is None:
+                return False
+            user_ids.update(found)
+        existing = await self.twitch.get_subscriptions()
+        if existing is None:
+            return False
+
+        # (event type, user id) -> subscription, only the ones sent to our callback
+        wanted = {(event_type, user_id) for user_id in user_ids.values() for event_type in EVENT_TYPES}
+        current = {}
+        for subscription in existing:
+            if subscription.get("transport", {}).get("callback") != self.eventsub_callback:
+                continue
+            key = (subscription["type"], subscription["condition"].get("broadcaster_user_id"))
+            if key in wanted and subscription["status"] in ("enabled", "webhook_callback_verification_pending"):
+                current[key] = subscription
+            else:
+                await self.twitch.delete_subscription(subscription["id"])
+
+        missing = sorted(wanted - set(current))
+        created = await asyncio.gather(*(self.twitch.create_subscription(event_type, user_id, self.eventsub_callback,
+                                                                         self.eventsub_secret)
+                                         for event_type, user_id in missing))
+        active = set(current) | {key for key, ok in zip(missing, created) if ok}
+
+        # broadcasters covered by both events only need the occasional fallback poll
+        self.user_logins = {user_id: login for login, user_id in user_ids.items()}
+        self.schedule.pushed = {login for login, user_id in user_ids.items()
+                                if all((event_type, user_id) in active for event_type in EVENT_TYPES)}
+        self.subscribed_logins = set(logins)
+        print(f"EventSub subscriptions: {len(active)} active, {sum(created)} created, "
+              f"{len(self.schedule.pushed)} of {len(logins)} broadcasters pushed")
+        return True
+
+    async def on_eventsub(self, message_type, subscription, event):
+        login = self.user_logins.get(subscription.get("condition", {}).get("broadcaster_user_id"))
+        if message_type == "revocation":
+            # poll the broadcaster normally again and subscribe again on the next check
+            print(f"EventSub subscription {subscription.get('type')} for {login} was revoked: "
+                  f"{subscription.get('status')}")
+            self.schedule.pushed.discard(login)
+            self.subscribed_logins = None
+            return
+
+        login = event.get("broadcaster_user_login", "").lower() or login
+        if subscription.get("type") == "stream.offline":
+            self.schedule.update([login], {}, time.time())
+        elif subscription.get("type") == "stream.online":
+            await self.announce_online(login)
+
+    async def announce_online(self, login):
+        # the stream can take a few seconds to show up in /helix/streams after going live
+        for _ in range(ONLINE_LOOKUP_ATTEMPTS):
+            streams = await self.twitch.get_streams([login])
+            if streams:
+                break
+            await asyncio.sleep(ONLINE_LOOKUP_DELAY)
+        else:
+            # leave it to the next poll
+            self.schedule.next_poll[login] = time.time()
+            return
+
+        self.schedule.update([login], {login: streams[0]}, time.time())
+        await self.announce_stream(streams[0], dict(self.settings.subscribers.get(login, {})))
+
+    def stats(self):
+        average_delivery = self.delivery_time / self.deliveries if self.deliveries else 0
+        stats = {"announcements sent": self.deliveries - self.delivery_failures,
+                 "announcements failed": self.delivery_failures,
+                 "average announcement latency (ms)": round(average_delivery * 1000, 1),
+                 "max announcement latency (ms)": round(self.max_delivery_time * 1000, 1),
+                 "longest event loop stall (ms)": round(self.loop_monitor.max_stall_ever * 1000, 1)}
+        stats.update(self.settings.stats())
+        stats.update(self.schedule.stats())
+        stats.update(self.announcements.stats())
+        stats.update(self.twitch.stats())
+        if self.eventsub:
+            stats.update(self.eventsub.stats())
+        return stats
 
     async def list_broadcasters(self, ctx, guild_id):
         # check if there are broadcasters set
-        if "names" in self.settings[guild_id]:
-            if "channel_id" in self.settings[guild_id]:
-                channel_id = f"<#{self.settings[guild_id]['channel_id']}>"
+        data = self.settings.guilds.get(guild_id, {})
+        if "names" in data:
+            if "channel_id" in data:
+                channel_id = f"<#{data['channel_id']}>"
             else:
                 channel_id = "None"
             # display
             broadcasters = "> "
-            broadcasters += "\n> ".join(self.settings[guild_id]["names"])
-            await ctx.send(
-                f"Current broadcasters set to check for this guild:\n> Announcement Channel: {channel_id}\n{broadcasters}")
+            broadcasters += "\n> ".join(data["names"])
+            await self.rest.respond(
+                ctx, f"Current broadcasters set to check for this guild:\n> Announcement Channel: {channel_id}\n"
+                     f"{broadcasters}")
         else:
-            await ctx.send("> There are no broadcasters set to check for this guild.")
+            await self.rest.respond(ctx, "> There are no broadcasters set to check for this guild.")
 
     async def force_announcement(self, ctx, guild_id, broadcaster_name):
         # check if we have a channel ID set for this guild
-        if guild_id in self.settings and "channel_id" in self.settings[guild_id]:
+        data = self.settings.guilds.get(guild_id, {})
+        if "channel_id" in data:
             # get channel
-            channel_id = self.settings[guild_id]["channel_id"]
+            channel_id = data["channel_id"]
             channel = self.bot.get_channel(channel_id)
 
             # make sure this is a real channel
             if channel:
-                # set up get request
-                url = "https://api.twitch.tv/helix/streams"
-                params = {
-                    "user_login": broadcaster_name
-                }
-                headers = {
-                    "Client-ID": self.twitch_client_id,
-                    "Authorization": f"Bearer {self.twitch_access_token}"
-                }
-
                 # send request
-                response = requests.get(url, params=params, headers=headers)
-                data = response.json()
+                streams = await self.twitch.get_streams([broadcaster_name])
 
                 # check for data
-                if data["data"]:
-                    # get data
-                    stream_data = data["data"][0]
-                    stream_title = stream_data["title"]
-                    stream_url = f"https://www.twitch.tv/{broadcaster_name}"
-                    viewer_count = stream_data["viewer_count"]
-                    game_name = stream_data["game_name"]
-
-                    # set up embed
-                    embed = discord.Embed(
-                        title=f"**{stream_title}**",
-                        url=stream_url,
-                        color=discord.Color.red()
-                    )
-                    embed.set_author(name=stream_data['user_name'])
-                    if stream_data['user_name'] == 'xFlxZh':
-                        # set custom thumbnail for flazh...
-                        embed.set_image(
-                            url='https://media.discordapp.net/attachments/1049713626895896686/1245587352693379154/live'
-                                'now.png?ex=66cdf7de&is=66cca65e&hm=3b0c29d57726e493805c28cacd4e81c400e549650bf3ced52'
-                                '2068d2a0cabdc66&=&format=webp&quality=lossless&width=550&height=309'.replace
-                            ("{width}", "320").replace("{height}", "180"))
-                    else:
-                        # default to Twitch stream thumbnail
-                        embed.set_image(
-                            url=stream_data['thumbnail_url'].replace("{width}", "320").replace("{height}", "180"))
-                    embed.set_thumbnail(url='https://media.discordapp.net/attachments/1049713626895896686/124558727353'
-                                            '8605117/newlogo.png?ex=66cdf7cb&is=66cca64b&hm=3a39e66fa6fbdce183d99f9f561'
-                                            '6ff24a2d357421bb52911b286ad2e6e586ac1&=&format=webp&quality=lossless&widt'
-                                            'h=920&height=460')
-                    embed.add_field(name="Viewers", value=viewer_count, inline=False)
-                    embed.add_field(name="Game", value=game_name, inline=False)
-
-                    # get mst current time
-                    mst_timezone = pytz.timezone('America/Phoenix')
-                    mst_now = datetime.now(tz=mst_timezone)
-                    embed.set_footer(text="Twitch • " + mst_now.strftime("%m/%d/%Y %I:%M %p"),
-                                     icon_url="https://cdn-longterm.mee6.xyz/plugins"
-                                              "/twitch/logo.png")
-
+                if streams:
                     # send the message
-                    await channel.send(
-                        f"Hey @everyone, {stream_data['user_name']} is now live on Twitch! Come and support the stream! Leave a comment and chat with them!",
-                        embed=embed)
+                    content, embed = build_announcement(streams[0])
+                    await self.rest.send(channel, content, embed=embed)
+                elif streams is None:
+                    await self.rest.respond(ctx, "> Could not reach Twitch, please try again later.")
                 else:
                     # assume there is no stream available
-                    await ctx.send(f"> {broadcaster_name} is currently offline.")
+                    await self.rest.respond(ctx, f"> {broadcaster_name} is currently offline.")
             else:
                 # assume there is no channel set yet
-                await ctx.send("> Announcement channel has not been set.")
-
-    async def send_live_stream_message(self, guild_id, stream_data):
-        # check if we have a channel ID set for this guild
-        if guild_id in self.settings and "channel_id" in self.settings[guild_id]:
-            # get channel
-            channel_id = self.settings[guild_id]["channel_id"]
+                await self.rest.respond(ctx, "> Announcement channel has not been set.")
+
+    async def announce_stream(self, stream_data, channel_ids):
+        # work out which guilds still need to hear about this stream, each stream is announced once and each
+        # broadcaster at most once every 6 hours (see AnnouncementLog)
+        current_time = time.time()
+        channels = []
+        for guild_id, channel_id in channel_ids.items():
+            # make sure the guild has a real announcement channel
             channel = self.bot.get_channel(channel_id)
-
-            # make sure this is a real channel
-            if channel:
-                # check that we have not made an announcement for this broadcaster within the last 6 hrs
-                # regardless of how many streams that start within that period (one per broadcaster every 6hr)
-                broadcaster_name = stream_data["user_name"]
-                current_time = datetime.now()
-                last_announcement_time = self.streams.get(guild_id, {}).get(broadcaster_name)
-                if not last_announcement_time or (current_time - last_announcement_time) > timedelta(hours=6):
-                    # assume no message has been sent for this specific streamer yet
-                    stream_title = stream_data["title"]
-                    stream_url = f"https://www.twitch.tv/{stream_data['user_name']}"
-                    viewer_count = stream_data["viewer_count"]
-                    game_name = stream_data["game_name"]
-
-                    # set up embed
-                    embed = discord.Embed(
-                        title=f"**{stream_title}**",  # Display name as title
-                        url=stream_url,
-                        color=discord.Color.red()
-                    )
-                    embed.set_author(name=stream_data['user_name'])
-                    if stream_data['user_name'] == 'xFlxZh':
-                        # set custom thumbnail for flazh...
-                        embed.set_image(
-                            url='https://media.discordapp.net/attachments/1049713626895896686/1245587352693379154/live'
-                                'now.png?ex=66cdf7de&is=66cca65e&hm=3b0c29d57726e493805c28cacd4e81c400e549650bf3ced52'
-                                '2068d2a0cabdc66&=&format=webp&quality=lossless&width=550&height=309'.replace
-                                ("{width}", "320").replace("{height}", "180"))
-                    else:
-                        # default to Twitch stream thumbnail
-                        embed.set_image(
-                            url=stream_data['thumbnail_url'].replace("{width}", "320").replace("{height}", "180"))
-
-                    embed.set_thumbnail(url='https://media.discordapp.net/attachments/1049713626895896686/124558727353'
-                                            '8605117/newlogo.png?ex=66cdf7cb&is=66cca64b&hm=3a39e66fa6fbdce183d99f9f561'
-                                            '6ff24a2d357421bb52911b286ad2e6e586ac1&=&format=webp&quality=lossless&widt'
-                                            'h=920&height=460')
-                    embed.add_field(name="Viewers", value=viewer_count, inline=False)
-                    embed.add_field(name="Game", value=game_name, inline=False)
-
-                    # get mst current time
-                    mst_timezone = pytz.timezone('America/Phoenix')
-                    mst_now = datetime.now(tz=mst_timezone)
-                    embed.set_footer(text="Twitch • " + mst_now.strftime("%m/%d/%Y %I:%M %p"),
-                                     icon_url="https://cdn-longterm.mee6.xyz/plugins"
-                                              "/twitch/logo.png")
-
-                    # send the message
-                    await channel.send(
-                        f"Hey @everyone, {stream_data['user_name']} is now live on Twitch! Come and support the stream! Leave a comment and chat with them!",
-                        embed=embed)
-                    self.streams.setdefault(guild_id, {})[broadcaster_name] = current_time
+            if channel and self.announcements.claim(guild_id, stream_data["user_login"].lower(), stream_data["id"],
+                                                    current_time):
+                channels.append(channel)
+        if not channels:
+            return
+
+        # remember the announcements right away so a restart can't send them again
+        await self.save_announcements()
+
+        # the same message goes to every guild, build it once and send it to all of them at the same time
+        content, embed = build_announcement(stream_data)
+        await asyncio.gather(*(self.deliver(channel, content, embed) for channel in channels))
+
+    async def save_announcements(self):
+        # one write at a time, off the event loop
+        async with self.announcements_lock:
+            entries = self.announcements.snapshot(time.time())
+            if entries is not None:
+                await self.bot.loop.run_in_executor(None, self.announcements.save, entries)
+
+    async def deliver(self, channel, content, embed):
+        # a slow or failing channel only holds up its own delivery
+        async with self.delivery_semaphore:
+            started = time.perf_counter()
+            try:
+                await self.rest.send(channel, content, embed=embed, priority=PRIORITY_BULK)
+            except discord.HTTPException as e:
+                self.delivery_failures += 1
+                print(f"Error announcing a stream in channel {channel.id}:", e)
+            finally:
+                latency = time.perf_counter() - started
+                self.deliveries += 1
+                self.delivery_time += latency
+                self.max_delivery_time = max(self.max_delivery_time, latency)
 
 
 def setup(bot):
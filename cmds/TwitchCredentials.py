@@ -0,0 +1,116 @@
+import asyncio
+import json
+import os
+import time
+
+"""
+Keeps the Twitch app access token valid.
+Remembers when the token expires and replaces it in the background before it does, concurrent callers that need a new
+token share one refresh, and the token is kept in its own file so a restart picks it up without touching .env.
+"""
+
+# refresh this many seconds before the token expires
+REFRESH_MARGIN = 3600
+
+# seconds between validations, twitch asks apps to validate their tokens hourly
+VALIDATE_INTERVAL = 3600
+
+
+class TwitchCredentials:
+    def __init__(self, client, access_token=None, token_file="./twitch_token.json"):
+        self.client = client
+        self.token_file = token_file
+        self.token = access_token
+        # None until we know when the token expires
+        self.expires_at = None
+        self.refresh_task = None
+        self.task = None
+        self.refreshes = 0
+        self.load()
+
+    def load(self):
+        # a token generated earlier wins over the one from .env
+        try:
+            with open(self.token_file, "r") as f:
+                data = json.load(f)
+            self.token, self.expires_at = data["access_token"], data["expires_at"]
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        # write to a temporary file and swap it in so a crash never leaves a half written file
+        with open(self.token_file + ".tmp", "w") as f:
+            json.dump({"access_token": self.token, "expires_at": self.expires_at}, f)
+        os.replace(self.token_file + ".tmp", self.token_file)
+
+    def expiring(self):
+        return self.expires_at is not None and self.expires_at - time.time() < REFRESH_MARGIN
+
+    async def get_token(self):
+        if not self.token or self.expiring():
+            return await self.refresh(self.token)
+        return self.token
+
+    async def refresh(self, stale_token=None):
+        # replaces stale_token, returns the current token if someone else already replaced it
+        if self.token and self.token != stale_token:
+            return self.token
+        # single flight, everyone waits for the same refresh
+        if self.refresh_task is None:
+            self.refresh_task = asyncio.get_event_loop().create_task(self.generate())
+        try:
+            return await asyncio.shield(self.refresh_task)
+        finally:
+            if self.refresh_task is not None and self.refresh_task.done():
+                self.refresh_task = None
+
+    async def generate(self):
+        generated = await self.client.get_oauth_token()
+        if generated is None:
+            return self.token
+        self.token, expires_in = generated
+        self.expires_at = time.time() + expires_in
+        self.refreshes += 1
+        print("Generated a new Twitch access token")
+        await asyncio.get_event_loop().run_in_executor(None, self.save)
+        return self.token
+
+    async def validate(self):
+        # checks the token with twitch and records when it expires, replacing it only if twitch rejects it
+        status, expires_in = await self.client.validate_token(self.token) if self.token else (401, None)
+        if status == 401:
+            print("Twitch access token is invalid... Generating a new one")
+            await self.refresh(self.token)
+            return
+        if status != 200:
+            # twitch couldn't be reached or had a problem, keep the token and check again next time
+            print("Could not validate the Twitch access token, status:", status)
+            return
+        self.expires_at = time.time() + expires_in
+        await asyncio.get_event_loop().run_in_executor(None, self.save)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    async def run(self):
+        while True:
+            if not self.token or self.expiring():
+                await self.refresh(self.token)
+            else:
+                await self.validate()
+            # sleep until the next validation, or until the token is about to expire
+            delay = VALIDATE_INTERVAL
+            if self.expires_at is not None:
+                delay = min(delay, self.expires_at - time.time() - REFRESH_MARGIN)
+            # don't hammer twitch if generating a token keeps failing
+            await asyncio.sleep(max(delay, 60))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def stats(self):
+        expires_in = round(self.expires_at - time.time()) if self.expires_at else "unknown"
+        return {"token refreshes": self.refreshes, "token expires in (s)": expires_in}
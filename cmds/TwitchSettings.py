@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import re
+
+"""
+Per guild Twitch settings ({"names": [...], "channel_id": ...}), kept in memory and stored as one small file per guild.
+Only the guild that changed is written, files are only read again when their mtime/size changes and their contents
+actually differ, and an index from broadcaster to the guilds (and channels) that follow them is kept up to date so the
+poller never has to go through every guild.
+"""
+
+
+# True if the name is a valid twitch login, twitch rejects a whole request if any login in it isn't
+def is_login(name):
+    return re.fullmatch(r"[a-z0-9_]{1,25}", name) is not None
+
+
+class TwitchSettings:
+    def __init__(self, settings_dir="./twitch_settings", legacy_file="./settings.json"):
+        self.settings_dir = settings_dir
+        self.guilds = {}
+        # guild id -> (mtime, size, hash) of its file when we last read or wrote it
+        self.files = {}
+        # broadcaster login -> {guild id: announcement channel id}, and guild id -> logins it is indexed under
+        self.subscribers = {}
+        self.followed = {}
+        # bumped every time the index changes
+        self.version = 0
+        self.reloads = 0
+        self.writes = 0
+
+        # split the old single settings file up the first time
+        if not os.path.exists(self.settings_dir):
+            os.makedirs(self.settings_dir)
+            try:
+                with open(legacy_file, "r") as f:
+                    for guild_id, data in json.load(f).items():
+                        self.guilds[guild_id] = data
+                        self.save(guild_id)
+            except FileNotFoundError:
+                pass
+        self.refresh()
+
+    def guild_file(self, guild_id):
+        return os.path.join(self.settings_dir, f"{guild_id}.json")
+
+    def guild(self, guild_id):
+        # the settings of a guild, created empty if it has none yet
+        return self.guilds.setdefault(guild_id, {})
+
+    def refresh(self):
+        # picks up files that were edited, added or removed outside the bot, returns True if anything changed
+        changed = False
+        seen = set()
+        for entry in os.scandir(self.settings_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            guild_id = entry.name[:-len(".json")]
+            seen.add(guild_id)
+            stat = entry.stat()
+            known = self.files.get(guild_id)
+            if known and known[:2] == (stat.st_mtime_ns, stat.st_size):
+                continue
+
+            # the file was touched, only reload it if the contents changed
+            with open(entry.path, "rb") as f:
+                data = f.read()
+            digest = hashlib.sha1(data).hexdigest()
+            self.files[guild_id] = (stat.st_mtime_ns, stat.st_size, digest)
+            if known and known[2] == digest:
+                continue
+            try:
+                self.guilds[guild_id] = json.loads(data)
+            except ValueError as e:
+                print(f"Error reading the Twitch settings of guild {guild_id}:", e)
+                continue
+            self.reloads += 1
+            self.index(guild_id)
+            changed = True
+
+        for guild_id in set(self.files) - seen:
+            del self.files[guild_id]
+            self.guilds.pop(guild_id, None)
+            self.index(guild_id)
+            changed = True
+        return changed
+
+    def save(self, guild_id):
+        # writes the guild's file and updates the index
+        data = json.dumps(self.guilds.get(guild_id, {})).encode()
+        guild_file = self.guild_file(guild_id)
+        # write to a temporary file and swap it in so a crash never leaves a half written file
+        with open(guild_file + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(guild_file + ".tmp", guild_file)
+        stat = os.stat(guild_file)
+        self.files[guild_id] = (stat.st_mtime_ns, stat.st_size, hashlib.sha1(data).hexdigest())
+        self.writes += 1
+        self.index(guild_id)
+
+    def index(self, guild_id):
+        # point the guild's broadcasters at it, and drop the ones it no longer follows. names that aren't valid logins
+        # are left out so they can't break the requests for everyone else
+        data = self.guilds.get(guild_id, {})
+        names = {name for name in data.get("names", []) if is_login(name)}
+        channel_id = data.get("channel_id")
+        for login in self.followed.get(guild_id, set()) - names:
+            guilds = self.subscribers[login]
+            del guilds[guild_id]
+            if not guilds:
+                del self.subscribers[login]
+        for login in names:
+            self.subscribers.setdefault(login, {})[guild_id] = channel_id
+        self.followed[guild_id] = names
+        self.version += 1
+
+    def stats(self):
+        return {"settings reloads": self.reloads, "settings writes": self.writes,
+                "followed broadcasters": len(self.subscribers)}
@@ -0,0 +1,84 @@
+import asyncio
+import time
+from collections import OrderedDict
+import discord
+
+"""
+Resolves user ids to display names for embeds such as the leaderboard.
+Looks in the guild's member cache first, then in a small LRU cache of users we already fetched, and only fetches
+whatever is left from the API, a few at a time.
+"""
+
+
+class UserResolver:
+    def __init__(self, bot, max_size=1000, ttl=3600, max_concurrency=5):
+        self.bot = bot
+        self.max_size = max_size
+        self.ttl = ttl
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        # user id -> (display name or None if the user doesn't exist, time fetched)
+        self.cache = OrderedDict()
+        self.member_hits = 0
+        self.cache_hits = 0
+        self.misses = 0
+
+    def cached(self, user_id):
+        # returns (found, display name)
+        if user_id not in self.cache:
+            return False, None
+        name, fetched_at = self.cache[user_id]
+        if time.time() - fetched_at > self.ttl:
+            del self.cache[user_id]
+            return False, None
+        self.cache.move_to_end(user_id)
+        return True, name
+
+    def remember(self, user_id, name):
+        self.cache[user_id] = (name, time.time())
+        self.cache.move_to_end(user_id)
+        # drop the least recently used users
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    async def fetch(self, user_id):
+        async with self.semaphore:
+            self.misses += 1
+            try:
+                user = await self.bot.fetch_user(user_id)
+            except discord.NotFound:
+                # remember that this user is gone so we don't keep asking
+                self.remember(user_id, None)
+                return None
+            except discord.HTTPException:
+                return None
+            self.remember(user_id, user.display_name)
+            return user.display_name
+
+    async def display_names(self, guild, user_ids):
+        # returns a dict of user id -> display name, or None if the user could not be found
+        names = {}
+        missing = []
+        for user_id in user_ids:
+            # check the guild's members first
+            member = guild.get_member(int(user_id)) if guild else None
+            if member:
+                self.member_hits += 1
+                names[user_id] = member.display_name
+                continue
+
+            # then the users we fetched before
+            found, name = self.cached(int(user_id))
+            if found:
+                self.cache_hits += 1
+                names[user_id] = name
+            else:
+                missing.append(user_id)
+
+        # fetch the rest concurrently
+        fetched = await asyncio.gather(*(self.fetch(int(user_id)) for user_id in missing))
+        names.update(zip(missing, fetched))
+        return names
+
+    def stats(self):
+        return {"member cache hits": self.member_hits, "user cache hits": self.cache_hits,
+                "user fetches": self.misses, "cached users": len(self.cache)}
@@ -3,7 +3,6 @@ import os
 from discord_slash import SlashCommand
 from discord.ext import commands
 from dotenv import load_dotenv
-from cmds.TwitchCmds import TwitchCmds
 
 client = commands.Bot(command_prefix='/', intents=discord.Intents.all())
 slash = SlashCommand(client, sync_commands=True)
@@ -21,8 +20,7 @@ async def on_ready():
     # set status
     await client.change_presence(activity=discord.Game(name="@brad.dev"))
     # Start checking Twitch streams
-    twitch_cmds = TwitchCmds(client)
-    client.loop.create_task(twitch_cmds.check_streams())
+    client.get_cog("TwitchCmds").start_checking()
 
 
 @client.event
@@ -44,3 +42,7 @@ load_dotenv()
 bot_token = os.getenv("BOT_TOKEN")
 slash.on_slash_command_error = on_command_error
 client.run(f"{bot_token}")
+
+# unload the cogs once the bot has shut down so they can flush anything they still hold
+for extension in list(client.extensions):
+    client.unload_extension(extension)
@@ -0,0 +1,84 @@
+import asyncio
+import json
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+import aiohttp
+
+sys.path.insert(0, ".")
+from cmds.EventSub import EventSubReceiver, sign
+
+"""
+Local stand-in for Twitch EventSub.
+Starts the receiver on localhost and sends it the messages Twitch would: a callback verification, a notification, the
+same notification redelivered, a message with a bad signature and a stale one, then checks how each was handled.
+Run from the repository root: python tools/eventsub_standin.py
+"""
+
+SECRET = "local-standin-secret"
+PORT = 8099
+
+
+def timestamp(age=0):
+    # RFC3339 with nanoseconds, like twitch sends
+    sent = datetime.now(timezone.utc) - timedelta(seconds=age)
+    return sent.strftime("%Y-%m-%dT%H:%M:%S.%f") + "123Z"
+
+
+async def send(session, message_type, payload, message_id=None, age=0, secret=SECRET):
+    body = json.dumps(payload).encode()
+    message_id = message_id or str(uuid.uuid4())
+    sent_at = timestamp(age)
+    headers = {
+        "Twitch-Eventsub-Message-Id": message_id,
+        "Twitch-Eventsub-Message-Timestamp": sent_at,
+        "Twitch-Eventsub-Message-Signature": sign(secret, message_id, sent_at, body),
+        "Twitch-Eventsub-Message-Type": message_type,
+        "Content-Type": "application/json"
+    }
+    async with session.post(f"http://127.0.0.1:{PORT}/eventsub", data=body, headers=headers) as response:
+        return response.status, await response.text()
+
+
+async def main():
+    events = []
+
+    async def on_event(message_type, subscription, event):
+        events.append((message_type, subscription.get("type"), event))
+
+    receiver = EventSubReceiver(SECRET, on_event, host="127.0.0.1", port=PORT)
+    await receiver.start()
+    subscription = {"type": "stream.online", "condition": {"broadcaster_user_id": "1234"}}
+    notification = {"subscription": subscription, "event": {"broadcaster_user_login": "someone"}}
+    failures = 0
+    try:
+        async with aiohttp.ClientSession() as session:
+            checks = [
+                ("verification echoes the challenge",
+                 await send(session, "webhook_callback_verification",
+                            {"subscription": subscription, "challenge": "abc123"}), (200, "abc123")),
+                ("notification is accepted", await send(session, "notification", notification, "message-1"),
+                 (204, "")),
+                ("redelivery is acknowledged", await send(session, "notification", notification, "message-1"),
+                 (204, "")),
+                ("bad signature is refused", await send(session, "notification", notification, secret="wrong"),
+                 (403, "")),
+                ("stale message is refused", await send(session, "notification", notification, age=3600),
+                 (403, "")),
+            ]
+        # let the callback run
+        await asyncio.sleep(0.1)
+        checks.append(("the notification was handed over once", len(events), 1))
+
+        for name, got, expected in checks:
+            ok = got == expected
+            failures += not ok
+            print(f"{'ok  ' if ok else 'FAIL'} {name}: {got}")
+        print(receiver.stats())
+    finally:
+        await receiver.stop()
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if asyncio.get_event_loop().run_until_complete(main()) else 0)
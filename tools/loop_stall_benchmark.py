@@ -0,0 +1,89 @@
+import asyncio
+import json
+import sys
+import threading
+import time
+import urllib.request
+from aiohttp import web
+
+sys.path.insert(0, ".")
+import cmds.TwitchClient
+from cmds.LoopMonitor import LoopMonitor
+from cmds.TwitchClient import TwitchClient
+
+"""
+Compares the longest event loop stall of a Twitch check before and after the move to aiohttp.
+A local HTTP server stands in for the Helix API and answers every request after a fixed delay. "before" looks every
+broadcaster up one by one with a blocking request like the old check did, "after" uses TwitchClient, which batches
+broadcasters and doesn't block the loop.
+Run from the repository root: python tools/loop_stall_benchmark.py [broadcasters] [delay in ms]
+"""
+
+PORT = 8098
+
+
+def start_standin(delay):
+    # runs the stand-in on its own thread and loop, so blocking requests from the bot's loop still get answered
+    async def streams(request):
+        await asyncio.sleep(delay)
+        return web.json_response({"data": []})
+
+    ready = threading.Event()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        app = web.Application()
+        app.router.add_get("/helix/streams", streams)
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", PORT).start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+
+
+async def measure(check):
+    # the longest stall while the check runs, and how long it took
+    monitor = LoopMonitor(interval=0.01)
+    monitor.start()
+    await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    await check()
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(0.05)
+    monitor.stop()
+    return monitor.max_stall_ever, elapsed
+
+
+async def main(broadcasters, delay):
+    url = f"http://127.0.0.1:{PORT}/helix/streams"
+    logins = [f"broadcaster{i}" for i in range(broadcasters)]
+
+    async def before():
+        # one blocking request per broadcaster, as the check did with requests.get
+        for login in logins:
+            with urllib.request.urlopen(f"{url}?user_login={login}") as response:
+                json.load(response)
+
+    cmds.TwitchClient.STREAMS_URL = url
+    client = TwitchClient("client-id", "secret", "token")
+
+    async def after():
+        # up to 100 broadcasters per request, as the check does now
+        for i in range(0, len(logins), 100):
+            await client.get_streams(logins[i:i + 100])
+
+    for name, check in (("before (blocking requests)", before), ("after (aiohttp)", after)):
+        stall, elapsed = await measure(check)
+        print(f"{name}: longest event loop stall {stall * 1000:.1f} ms, check took {elapsed * 1000:.1f} ms")
+    await client.close()
+
+
+if __name__ == "__main__":
+    broadcasters = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    delay = int(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.05
+    start_standin(delay)
+    asyncio.get_event_loop().run_until_complete(main(broadcasters, delay))